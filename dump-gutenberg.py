@@ -11,31 +11,52 @@ from docopt import docopt
 from path import path
 
 from gutenberg import logger
-from gutenberg.database import setup_database
-from gutenberg.rdf import setup_rdf_folder, parse_and_fill
+from gutenberg.database import setup_database, migrate_database
+from gutenberg.rdf import (setup_rdf_folder, parse_and_fill,
+                           RDF_PARSERS, RDF_TARBALL)
+from gutenberg.snapshot import load_snapshot
 from gutenberg.download import download_all_books
-from gutenberg.export import export_all_books
+from gutenberg.export import export_all_books, HTML_UPDATERS
 from gutenberg.zim import build_zimfile
 from gutenberg.checkdeps import check_dependencies
+from gutenberg.utils import LINK_MODES
 
 
-help = ("""Usage: dump-gutenberg.py [-k] [-l LANGS] [-f FORMATS] """
-        """[-r RDF_FOLDER] [-m URL_MIRROR] [-d CACHE_PATH] [-e STATIC_PATH] [-z ZIM_PATH] [-u RDF_URL] [-b BOOKS] """
+help = ("""Usage: dump-gutenberg.py [-k] [-i] [-l LANGS] [-f FORMATS] [--filter-on-parse] [--popularity-by-language] """
+        """[-r RDF_FOLDER] [-t] [-s] [-m URL_MIRROR] [-d CACHE_PATH] [-e STATIC_PATH] [-z ZIM_PATH] [-u RDF_URL] [-b BOOKS] """
+        """[--parse-workers=NB] [--rdf-parser=ENGINE] [--download-workers=NB] [--downloads-per-host=NB] [--http-timeout=SECONDS] [--export-workers=NB] [--html-parser=ENGINE] [--link-mode=MODE] """
+        """[--write-snapshot=SNAPSHOT] [--from-snapshot=SNAPSHOT] """
         """[--prepare] [--parse] [--download] [--export] [--zim] [--complete]
 
 -h --help                       Display this help message
 -k --keep-db                    Do not wipe the DB during parse stage
+-i --incremental                Only parse RDF files changed since last parse and remove books not in catalog anymore (implies --keep-db).
+                                Only export books which files or metadata changed since last export
 
 -l --languages=<list>           Comma-separated list of lang codes to filter export to (preferably ISO 639-1, else ISO 639-3)
 -f --formats=<list>             Comma-separated list of formats to filter export to (epub, html, pdf, all)
+--filter-on-parse               Apply --languages and --formats at parse stage: out-of-scope books and formats are not stored in DB
+--popularity-by-language        Rank books' popularity against books in the same language only (with --export)
 
 -m --mirror=<url>               Use URL as base for all downloads.
 -r --rdf-folder=<folder>        Don't download rdf-files.tar.bz2 and use extracted folder instead
+-t --from-tarball               Parse RDF files straight out of rdf-files.tar.bz2 (no extraction)
+-s --stream-rdf                 Download, decompress and parse rdf-files.tar.bz2 as a single pipelined stream (with --parse)
 -e --static-folder=<folder>     Use-as/Write-to this folder static HTML
 -z --zim-file=<file>            Write ZIM into this file path
 -d --dl-folder=<folder>         Folder to use/write-to downloaded ebooks
 -u --rdf-url=<url>              Alternative rdf-files.tar.bz2 URL
 -b --books=<ids>                Execute the processes for specific books, separated by commas, or dashes for intervals
+--parse-workers=<nb>            Number of processes parsing RDF files in parallel [default: 1]
+--rdf-parser=<engine>           RDF parser engine: bs4 or lxml (faster) [default: bs4]
+--download-workers=<nb>         Number of files downloaded in parallel [default: 1]
+--downloads-per-host=<nb>       Max number of parallel requests to a single host [default: 4]
+--http-timeout=<seconds>        Seconds to wait for mirrors to accept a connection or send data [default: 60]
+--export-workers=<nb>           Number of processes exporting books in parallel [default: 1]
+--html-parser=<engine>          HTML engine updating books for export: bs4 or lxml (faster) [default: bs4]
+--link-mode=<mode>              How files exported unmodified (PDF, etc.) are put in static folder: copy, hardlink, reflink or symlink [default: copy]
+--write-snapshot=<file>         Also write parsed RDF files to this catalog snapshot (with --parse)
+--from-snapshot=<file>          Fill-up the DB from this catalog snapshot instead of parsing RDF files
 
 -x --zim-title=<title>          Custom title for the ZIM file
 -q --zim-desc=<desc>            Custom description for the ZIM file
@@ -64,14 +85,29 @@ def main(arguments):
 
     URL_MIRROR = arguments.get('--mirror') or 'http://zimfarm.kiwix.org/gutenberg'
     RDF_FOLDER = arguments.get('--rdf-folder') or os.path.join('rdf-files')
+    FROM_TARBALL = arguments.get('--from-tarball', False)
+    STREAM_RDF = arguments.get('--stream-rdf', False)
     STATIC_FOLDER = arguments.get('--static-folder') or os.path.join('static')
     ZIM_FILE = arguments.get('--zim-file')
-    WIPE_DB = not arguments.get('--keep-db') or False
+    INCREMENTAL = arguments.get('--incremental', False)
+    WIPE_DB = not (arguments.get('--keep-db') or INCREMENTAL)
     RDF_URL = arguments.get('--rdf-url') or 'http://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2'
     DL_CACHE = arguments.get('--dl-folder') or os.path.join('dl-cache')
     BOOKS = arguments.get('--books') or ''
     ZTITLE = arguments.get('--zim-title')
     ZDESC = arguments.get('--zim-desc')
+    PARSE_WORKERS = int(arguments.get('--parse-workers') or 1)
+    DOWNLOAD_WORKERS = int(arguments.get('--download-workers') or 1)
+    DOWNLOADS_PER_HOST = int(arguments.get('--downloads-per-host') or 4)
+    HTTP_TIMEOUT = float(arguments.get('--http-timeout') or 60)
+    EXPORT_WORKERS = int(arguments.get('--export-workers') or 1)
+    HTML_PARSER = arguments.get('--html-parser') or 'bs4'
+    LINK_MODE = arguments.get('--link-mode') or 'copy'
+    RDF_PARSER = arguments.get('--rdf-parser') or 'bs4'
+    WRITE_SNAPSHOT = arguments.get('--write-snapshot')
+    FROM_SNAPSHOT = arguments.get('--from-snapshot')
+    FILTER_ON_PARSE = arguments.get('--filter-on-parse', False)
+    POPULARITY_BY_LANGUAGE = arguments.get('--popularity-by-language', False)
 
     # create tmp dir
     path('tmp').mkdir_p()
@@ -101,6 +137,11 @@ def main(arguments):
         logger.error(e)
         BOOKS = []
 
+    if FILTER_ON_PARSE:
+        PARSE_FILTERS = {'languages': LANGUAGES, 'formats': FORMATS}
+    else:
+        PARSE_FILTERS = {}
+
     # no arguments, default to --complete
     if not (DO_PREPARE + DO_PARSE + DO_DOWNLOAD + DO_EXPORT + DO_ZIM):
         COMPLETE_DUMP = True
@@ -109,20 +150,60 @@ def main(arguments):
         DO_CHECKDEPS = DO_PREPARE = DO_PARSE = \
             DO_DOWNLOAD = DO_EXPORT = DO_ZIM = True
 
+    if DO_PARSE and RDF_PARSER not in RDF_PARSERS:
+        logger.error("Unavailable RDF parser engine `{}`. Choose from: {}"
+                     .format(RDF_PARSER, ", ".join(RDF_PARSERS.keys())))
+        sys.exit(1)
+
+    if DO_EXPORT and HTML_PARSER not in HTML_UPDATERS:
+        logger.error("Unavailable HTML parser engine `{}`. Choose from: {}"
+                     .format(HTML_PARSER, ", ".join(HTML_UPDATERS.keys())))
+        sys.exit(1)
+
+    if DO_EXPORT and LINK_MODE not in LINK_MODES:
+        logger.error("Unavailable link mode `{}`. Choose from: {}"
+                     .format(LINK_MODE, ", ".join(LINK_MODES)))
+        sys.exit(1)
+
     if DO_CHECKDEPS:
         logger.info("CHECKING for dependencies on the system")
         if not check_dependencies()[0]:
             logger.error("Exiting...")
             sys.exit(1)
 
+    # download & extraction are part of the streamed parse stage
+    # and not needed at all when loading a snapshot
+    if (STREAM_RDF or FROM_SNAPSHOT) and DO_PARSE:
+        DO_PREPARE = False
+
     if DO_PREPARE:
         logger.info("PREPARING rdf-files cache from {}".format(RDF_URL))
-        setup_rdf_folder(rdf_url=RDF_URL, rdf_path=RDF_FOLDER)
+        setup_rdf_folder(rdf_url=RDF_URL, rdf_path=RDF_FOLDER,
+                         extract=not FROM_TARBALL, timeout=HTTP_TIMEOUT)
 
-    if DO_PARSE:
-        logger.info("PARSING rdf-files in {}".format(RDF_FOLDER))
+    if DO_PARSE and FROM_SNAPSHOT:
+        logger.info("LOADING catalog snapshot {}".format(FROM_SNAPSHOT))
         setup_database(wipe=WIPE_DB)
-        parse_and_fill(rdf_path=RDF_FOLDER, only_books=BOOKS)
+        load_snapshot(FROM_SNAPSHOT, only_books=BOOKS, **PARSE_FILTERS)
+
+    elif DO_PARSE:
+        if STREAM_RDF:
+            rdf_source = RDF_TARBALL if path(RDF_TARBALL).exists() \
+                else RDF_URL
+        elif FROM_TARBALL:
+            rdf_source = RDF_TARBALL
+        else:
+            rdf_source = RDF_FOLDER
+        logger.info("PARSING rdf-files in {}".format(rdf_source))
+        setup_database(wipe=WIPE_DB)
+        parse_and_fill(rdf_path=rdf_source, only_books=BOOKS,
+                       nb_workers=PARSE_WORKERS, engine=RDF_PARSER,
+                       incremental=INCREMENTAL, snapshot=WRITE_SNAPSHOT,
+                       timeout=HTTP_TIMEOUT, **PARSE_FILTERS)
+
+    elif DO_DOWNLOAD or DO_EXPORT:
+        # DB from a previous parse might predate the current schema
+        migrate_database()
 
     if DO_DOWNLOAD:
         logger.info("DOWNLOADING ebooks from mirror using filters")
@@ -130,7 +211,10 @@ def main(arguments):
                            download_cache=DL_CACHE,
                            languages=LANGUAGES,
                            formats=FORMATS,
-                           only_books=BOOKS)
+                           only_books=BOOKS,
+                           nb_workers=DOWNLOAD_WORKERS,
+                           downloads_per_host=DOWNLOADS_PER_HOST,
+                           timeout=HTTP_TIMEOUT)
 
     if DO_EXPORT:
         logger.info("EXPORTING ebooks to static folder (and JSON)")
@@ -138,7 +222,12 @@ def main(arguments):
                          download_cache=DL_CACHE,
                          languages=LANGUAGES,
                          formats=FORMATS,
-                         only_books=BOOKS)
+                         only_books=BOOKS,
+                         popularity_by_language=POPULARITY_BY_LANGUAGE,
+                         nb_workers=EXPORT_WORKERS,
+                         html_engine=HTML_PARSER,
+                         incremental=INCREMENTAL,
+                         link_mode=LINK_MODE)
 
     if DO_ZIM:
         if not check_dependencies()[1]:
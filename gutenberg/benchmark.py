@@ -0,0 +1,1137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import os
+import re
+import sys
+import json
+import time
+import random
+import tarfile
+import platform
+import tempfile
+import threading
+import posixpath
+import urlparse
+import SocketServer
+import BaseHTTPServer
+import SimpleHTTPServer
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+
+from docopt import docopt
+from path import path
+
+from gutenberg import logger, TMP_FOLDER
+from gutenberg.database import (db, use_database, setup_database, insert_rows,
+                                Author, Book, BookFormat, Format, License,
+                                RdfFile)
+from gutenberg.rdf import (rdf_entries_in_folder, rdf_files_in,
+                           parse_rdf_entry, process_parsed_rdf,
+                           process_parsed_rdfs, parse_and_fill,
+                           compare_parsers, gid_for, RDF_TARBALL)
+from gutenberg.utils import (get_list_of_filtered_books, http_session,
+                             FORMAT_MATRIX)
+from gutenberg.export import (authors_from_ids, update_html_for_static,
+                              HTML_UPDATERS, BOILERPLATE_PATTERNS)
+from gutenberg.urls import UrlBuilder
+from gutenberg.download import (download_all_books, download_jobs,
+                                DOWNLOADS_PER_HOST)
+
+
+help = """Usage: benchmark.py generate <rdf_folder> [--scale=NB] [--seed=SEED]
+       benchmark.py run [<rdf_folder>] [--scale=NB] [--seed=SEED] [--rdf-parser=ENGINE] [--parse-workers=NB] [--output=FILE]
+       benchmark.py loaders <rdf_folder> [--rdf-parser=ENGINE]
+       benchmark.py parsers [<rdf_folder>] [--scale=NB] [--seed=SEED]
+       benchmark.py compare <before> <after>
+       benchmark.py indexes [<database>]
+       benchmark.py authors [--authors=NB]
+       benchmark.py html [<html_file>...] [--epub]
+       benchmark.py download [--scale=NB] [--seed=SEED] [--download-workers=NB] [--downloads-per-host=NB] [--delay=SECONDS]
+       benchmark.py stream [--scale=NB] [--seed=SEED] [--parse-workers=NB]
+
+Benchmarks the parse stage on a real or synthetic catalog.
+
+generate                        Write a synthetic catalog of --scale books in <rdf_folder>
+run                             Time RdfParser.parse, DB loading and parse_and_fill.
+                                Uses a synthetic catalog if <rdf_folder> is not set
+loaders                         Time the DB loading of parsed RDF files, per book vs in bulk
+parsers                         Check that the RDF parser engines parse every file the same way.
+                                Uses a synthetic catalog if <rdf_folder> is not set
+compare                         Compare the results of two `run --output` files
+indexes                         Check with EXPLAIN QUERY PLAN that the main catalog queries
+                                use an index rather than a table scan (on an empty DB by default)
+authors                         Time authors_from_ids on a DB of --authors authors
+html                            Check that the HTML engines of update_html_for_static produce
+                                the same document for each file, and time them.
+                                Uses synthetic HTML and ePUB files if no <html_file> is set
+download                        Time the download stage of a synthetic catalog from local mirrors,
+                                checking that all files are downloaded and per-host limits are kept
+stream                          Time parse_and_fill on the URL of a synthetic rdf-files.tar.bz2 served
+                                by a local mirror, checking that it fills the DB as parsing the
+                                extracted folder does and that the saved tarball is the served one
+
+--scale=<nb>                    Number of books in synthetic catalog (1000, 10000, 100000…) [default: 1000]
+--seed=<seed>                   Random seed of the synthetic catalog [default: 42]
+--rdf-parser=<engine>           RDF parser engine: bs4 or lxml [default: bs4]
+--parse-workers=<nb>            Number of processes parsing RDF files in parallel [default: 1]
+--output=<file>                 Write results to this JSON file
+--authors=<nb>                  Number of authors in DB [default: 50000]
+--epub                          HTML files are from ePUB files
+--download-workers=<nb>         Number of files downloaded in parallel [default: 1]
+--downloads-per-host=<nb>       Max number of parallel requests to a single host [default: 4]
+--delay=<seconds>               Response time of the local mirrors [default: 0.05]
+"""
+
+RESULTS_VERSION = 2
+
+SYNTHETIC_LANGUAGES = ['en'] * 12 + ['fr', 'fr', 'de', 'de', 'fi', 'nl',
+                                     'it', 'es', 'pt', 'eo', 'la', 'zh']
+
+SYNTHETIC_LICENSES = (["Public domain in the USA."] * 18 +
+                      ["Copyrighted. Read the copyright notice inside "
+                       "this book for details.", "None"])
+
+# (URL of file, list of MIME) as found in Gutenberg's RDF files.
+# zipped files have two formats: the zipped one and application/zip.
+SYNTHETIC_FILES = [
+    ("ebooks/{id}.epub.images", ["application/epub+zip"]),
+    ("ebooks/{id}.epub.noimages", ["application/epub+zip"]),
+    ("ebooks/{id}.kindle.images", ["application/x-mobipocket-ebook"]),
+    ("ebooks/{id}.html.images", ["text/html; charset=utf-8"]),
+    ("files/{id}/{id}-h/{id}-h.htm", ["text/html; charset=iso-8859-1"]),
+    ("files/{id}/{id}-h.zip", ["text/html; charset=iso-8859-1",
+                               "application/zip"]),
+    ("files/{id}/{id}-0.txt", ["text/plain; charset=utf-8"]),
+    ("files/{id}/{id}-8.txt", ["text/plain; charset=iso-8859-1"]),
+    ("files/{id}/{id}-8.zip", ["text/plain; charset=iso-8859-1",
+                               "application/zip"]),
+    ("ebooks/{id}.txt.utf-8", ["text/plain; charset=utf-8"]),
+    ("files/{id}/{id}-pdf.pdf", ["application/pdf"]),
+    ("ebooks/{id}.rdf", ["application/rdf+xml"]),
+    ("cache/epub/{id}/pg{id}.cover.medium.jpg", ["image/jpeg"]),
+    ("cache/epub/{id}/pg{id}.qrcode.png", ["image/png"]),
+]
+
+RDF_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xml:base="http://www.gutenberg.org/"
+  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+  xmlns:pgterms="http://www.gutenberg.org/2009/pgterms/"
+  xmlns:dcterms="http://purl.org/dc/terms/"
+  xmlns:dcam="http://purl.org/dc/dcam/"
+  xmlns:marcrel="http://id.loc.gov/vocabulary/relators/"
+  xmlns:cc="http://web.resource.org/cc/">
+  <cc:Work rdf:about="">
+    <cc:license rdf:resource="https://www.gnu.org/licenses/gpl.html"/>
+  </cc:Work>
+"""
+
+RDF_FOOTER = """  <rdf:Description rdf:about="http://en.wikipedia.org/">
+    <dcterms:description>en.wikipedia</dcterms:description>
+  </rdf:Description>
+</rdf:RDF>
+"""
+
+
+def synthetic_date(rand):
+    """ birth/death date as found in RDF files: often missing, sometimes
+        BC (negative), sometimes not even a number """
+    return rand.choice([None, None, None,
+                        "{}".format(rand.randint(1000, 1950)),
+                        "{}".format(rand.randint(1000, 1950)),
+                        "-{}".format(rand.randint(1, 800)),
+                        "?", ""])
+
+
+def synthetic_agent(rand, author_id):
+    lines = ['<pgterms:agent rdf:about="2009/agents/{}">'.format(author_id)]
+    first_names = rand.choice(["John", "Marie-Anne", "J. R. R.", "", "Li"])
+    last_name = rand.choice(["Doe", "Dupont", "von Goethe", "Anonymous",
+                             "Çélèste", "O'Brien & Sons"])
+    name = "{l}{sep}{f}".format(l=last_name, f=first_names,
+                                sep=", " if first_names else "")
+    if rand.random() < 0.05:
+        name = "{}, Jr., {}".format(last_name, first_names)
+    # names are sometimes empty or blank: both mean no name
+    blank = rand.random()
+    if blank < 0.02:
+        lines.append("<pgterms:name/>")
+    elif blank < 0.04:
+        lines.append("<pgterms:name>\n        </pgterms:name>")
+    else:
+        lines.append("<pgterms:name>{}</pgterms:name>".format(escape(name)))
+    for _ in range(rand.randint(0, 2)):
+        lines.append("<pgterms:alias>{}</pgterms:alias>"
+                     .format(escape(name[::-1])))
+    for tag in ('birthdate', 'deathdate'):
+        date = synthetic_date(rand)
+        if date is not None:
+            lines.append(
+                '<pgterms:{tag} rdf:datatype="http://www.w3.org/2001/'
+                'XMLSchema#integer">{date}</pgterms:{tag}>'
+                .format(tag=tag, date=date))
+    lines.append('<pgterms:webpage rdf:resource='
+                 '"http://en.wikipedia.org/wiki/{}"/>'.format(author_id))
+    lines.append('</pgterms:agent>')
+    return "\n      ".join(lines)
+
+
+def synthetic_rdf(rand, book_id, nb_authors):
+    """ content of a pg{book_id}.rdf file """
+    lines = [RDF_HEADER,
+             '  <pgterms:ebook rdf:about="ebooks/{}">'.format(book_id)]
+
+    title = rand.choice(["The Adventures of Book #{id}",
+                         "Les Misérables, Tome {id}",
+                         "Book {id}\nA subtitle; or, The Long Story",
+                         "Tom & Jerry <{id}>"]).format(id=book_id)
+    lines.append("    <dcterms:title>{}</dcterms:title>"
+                 .format(escape(title)))
+
+    # creators: none, one (most often), or several ; sometimes a
+    # reference to an agent described elsewhere ; sometimes a compiler.
+    nb_creators = rand.choice([0, 1, 1, 1, 1, 1, 2, 3])
+    for _ in range(nb_creators):
+        author_id = rand.randint(1, nb_authors)
+        if rand.random() < 0.05:
+            lines.append('    <dcterms:creator rdf:resource='
+                         '"2009/agents/{}"/>'.format(author_id))
+        else:
+            lines.append('    <dcterms:creator>\n      {}\n'
+                         '    </dcterms:creator>'
+                         .format(synthetic_agent(rand, author_id)))
+    if rand.random() < 0.1:
+        lines.append('    <marcrel:com>\n      {}\n    </marcrel:com>'
+                     .format(synthetic_agent(rand, rand.randint(1, nb_authors))))
+    if rand.random() < 0.2:
+        lines.append('    <marcrel:ill>\n      {}\n    </marcrel:ill>'
+                     .format(synthetic_agent(rand, rand.randint(1, nb_authors))))
+
+    lines.append('    <dcterms:language><rdf:Description><rdf:value '
+                 'rdf:datatype="http://purl.org/dc/terms/RFC4646">{}'
+                 '</rdf:value></rdf:Description></dcterms:language>'
+                 .format(rand.choice(SYNTHETIC_LANGUAGES)))
+    lines.append('    <pgterms:downloads rdf:datatype="http://www.w3.org/'
+                 '2001/XMLSchema#integer">{}</pgterms:downloads>'
+                 .format(int(rand.paretovariate(1.2) * 10) - 10))
+    lines.append('    <dcterms:rights>{}</dcterms:rights>'
+                 .format(rand.choice(SYNTHETIC_LICENSES)))
+    lines.append('    <dcterms:issued rdf:datatype="http://www.w3.org/2001/'
+                 'XMLSchema#date">{}-01-01</dcterms:issued>'
+                 .format(rand.randint(1971, 2014)))
+    for _ in range(rand.randint(1, 4)):
+        lines.append('    <dcterms:subject><rdf:Description>'
+                     '<dcam:memberOf rdf:resource="http://purl.org/dc/'
+                     'terms/LCSH"/><rdf:value>Fiction -- {}</rdf:value>'
+                     '</rdf:Description></dcterms:subject>'
+                     .format(rand.randint(1, 500)))
+
+    for url, mimes in rand.sample(SYNTHETIC_FILES,
+                                  rand.randint(3, len(SYNTHETIC_FILES))):
+        url = "http://www.gutenberg.org/{}".format(url.format(id=book_id))
+        lines.append('    <dcterms:hasFormat>\n'
+                     '      <pgterms:file rdf:about={}>'.format(quoteattr(url)))
+        lines.append('        <dcterms:extent rdf:datatype="http://www.w3.org/'
+                     '2001/XMLSchema#integer">{}</dcterms:extent>'
+                     .format(rand.randint(1000, 10 ** 7)))
+        for mime in mimes:
+            lines.append('        <dcterms:format><rdf:Description>'
+                         '<dcam:memberOf rdf:resource="http://purl.org/dc/'
+                         'terms/IMT"/><rdf:value rdf:datatype="http://purl.'
+                         'org/dc/terms/IMT">{}</rdf:value></rdf:Description>'
+                         '</dcterms:format>'.format(mime))
+        lines.append('        <dcterms:isFormatOf rdf:resource='
+                     '"ebooks/{}"/>'.format(book_id))
+        lines.append('      </pgterms:file>\n    </dcterms:hasFormat>')
+
+    lines.append('  </pgterms:ebook>')
+    lines.append(RDF_FOOTER)
+    return "\n".join(lines)
+
+
+def generate_catalog(rdf_path, nb_books=1000, seed=42):
+    """ writes a synthetic catalog of nb_books RDF files in rdf_path,
+        laid out like the extracted rdf-files.tar.bz2 """
+    logger.info("Generating {} synthetic RDF files in {}"
+                .format(nb_books, rdf_path))
+    rand = random.Random(seed)
+    nb_authors = max(1, nb_books // 3)
+    for book_id in range(1, nb_books + 1):
+        folder = os.path.join(rdf_path, str(book_id))
+        path(folder).makedirs_p()
+        with open(os.path.join(folder, "pg{}.rdf".format(book_id)),
+                  'w') as f:
+            f.write(synthetic_rdf(rand, book_id, nb_authors).encode('utf-8'))
+
+
+def write_tarball(rdf_path, rdf_tarball):
+    """ writes the RDF files of rdf_path to rdf_tarball, laid out as in
+        rdf-files.tar.bz2 and in the order they are parsed from rdf_path """
+    with tarfile.open(rdf_tarball, mode='w:bz2') as tar:
+        for rdf_file in rdf_files_in(rdf_path):
+            tar.add(rdf_file, arcname=posixpath.join(
+                'cache', 'epub', *os.path.relpath(rdf_file, rdf_path)
+                                        .split(os.sep)))
+
+
+HTML_HEAD = """<head>
+<meta http-equiv="Content-Type" content="text/html; charset={charset}" />
+<title>The Project Gutenberg eBook of Book #{id}</title>
+<style type="text/css">p {{ text-indent: 1em; }}</style>
+</head>"""
+
+HTML_DOCTYPE = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+                '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">')
+
+XHTML_HEADER = ('<?xml version="1.0" encoding="utf-8"?>\n' + HTML_DOCTYPE +
+                '\n<html xmlns="http://www.w3.org/1999/xhtml" '
+                'xml:lang="en">')
+
+# (src of <img>, href of <a>) as found in Gutenberg's HTML files
+SYNTHETIC_LINKS = [
+    ("images/cover.jpg", "#chap01"),
+    ("images/illus/p012.png", "chap02.html"),
+    ("images/p013.png", "chap02.html#page13"),
+    ("http://www.gutenberg.org/images/logo.png",
+     "http://www.gutenberg.org/ebooks/{id}"),
+    ("../images/p014.jpg", "../{id}-h/{id}-h.htm#page14"),
+    ("p015.gif", ""),
+    (None, None),
+]
+
+
+def synthetic_html_body(book_id, markers=(), nested=False):
+    """ body of a book in which markers (strings) are each alone in a
+        paragraph, between chapters with images and links """
+    lines = ['<body>', '<p>Title: Book #{}</p>'.format(book_id)]
+    for index, marker in enumerate(list(markers) + [None]):
+        src, href = SYNTHETIC_LINKS[index % len(SYNTHETIC_LINKS)]
+        lines.append('<div class="chapter"><h2><a name="chap{i:02}" id='
+                     '"chap{i:02}">Chapter {i}</a></h2>'.format(i=index))
+        if src is not None:
+            lines.append('<p><img src={} alt="" /></p>'.format(
+                quoteattr(src)))
+        if href is not None:
+            lines.append('<p>See <a href={}>there</a>.</p>'.format(
+                quoteattr(href.format(id=book_id))))
+        lines.append('<pre>  Some   preformatted\n    text  </pre>\n'
+                     '</div>\n\n   ')
+        if marker is None:
+            continue
+        paragraph = '<p>{} BOOK #{} ***</p>'.format(escape(marker), book_id)
+        if nested:
+            paragraph = '<div><div>{}</div></div>'.format(paragraph)
+        lines.append(paragraph)
+        lines.append('<!-- end of marker {} -->'.format(index))
+    lines.append('<p>End of book #{}</p>'.format(book_id))
+    lines.append('</body>')
+    return "\n".join(lines)
+
+
+def synthetic_html(book_id, markers=(), nested=False, epub=False,
+                   doctype=True, charset='utf-8', encapsulated=False):
+    """ content of an HTML (or XHTML, in ePUB files) file of a book """
+    body = synthetic_html_body(book_id, markers=markers, nested=nested)
+    if encapsulated:
+        body = body.replace('<body>', '<body>\n<div>', 1) \
+                   .replace('</body>', '</div>\n</body>', 1)
+    if epub:
+        header = XHTML_HEADER
+    else:
+        header = (HTML_DOCTYPE + '\n<html>') if doctype else '<html>'
+    html = "\n".join([header, HTML_HEAD.format(charset=charset, id=book_id),
+                      body, '</html>\n'])
+    return html.encode(charset)
+
+
+def synthetic_html_cases():
+    """ [(name, synthetic_html() kwargs)] covering every start/end pair
+        of BOILERPLATE_PATTERNS, found alone or along with others """
+    cases = []
+    for index, (start, end) in enumerate(BOILERPLATE_PATTERNS):
+        cases += [("pattern{}-both".format(index), {'markers': [start, end]}),
+                  ("pattern{}-start".format(index), {'markers': [start]}),
+                  ("pattern{}-end".format(index), {'markers': [end]}),
+                  ("pattern{}-nested".format(index),
+                   {'markers': [start, end], 'nested': True})]
+
+    starts = [start for start, _ in BOILERPLATE_PATTERNS]
+    ends = [end for _, end in BOILERPLATE_PATTERNS]
+    cases += [
+        ("no-pattern", {}),
+        # markers of several pairs: the first pair listed wins
+        ("all-starts", {'markers': starts}),
+        ("all-ends", {'markers': ends}),
+        ("all-patterns", {'markers': starts + ends}),
+        ("end-before-start", {'markers': [ends[0], starts[0]]}),
+        # a single child in body: markers are left in place
+        ("encapsulated", {'markers': [starts[0], ends[0]],
+                          'encapsulated': True}),
+        ("no-doctype", {'markers': [starts[0], ends[0]], 'doctype': False}),
+        ("latin-1", {'markers': [starts[1], ends[1]],
+                     'charset': 'iso-8859-1'}),
+    ]
+    return cases
+
+
+def generate_html_fixtures(html_path):
+    """ writes synthetic HTML files in html_path/html and XHTML ones (as in
+        ePUB files) in html_path/epub ; returns {epub: [file path]} """
+    logger.info("Generating synthetic HTML files in {}".format(html_path))
+    fpaths = {False: [], True: []}
+    for book_id, (name, kwargs) in enumerate(synthetic_html_cases(), 1):
+        for epub in (False, True):
+            if epub and 'doctype' in kwargs:
+                continue
+            folder = os.path.join(html_path, 'epub' if epub else 'html')
+            path(folder).makedirs_p()
+            fpath = os.path.join(folder, "{}.{}".format(
+                name, 'xhtml' if epub else 'html'))
+            with open(fpath, 'wb') as f:
+                f.write(synthetic_html(book_id, epub=epub, **kwargs))
+            fpaths[epub].append(fpath)
+    return fpaths
+
+
+def rate(nb, duration):
+    return nb / duration if duration else 0
+
+
+@contextmanager
+def temporary_database():
+    """ empty DB in TMP_FOLDER, bound to the models while in use """
+    db_path = tempfile.NamedTemporaryFile(suffix='.db', dir=TMP_FOLDER)
+    db_path.close()
+    use_database(db_path.name)
+    try:
+        setup_database(wipe=True)
+        yield db_path.name
+    finally:
+        db.close()
+        path(db_path.name).unlink_p()
+
+
+@contextmanager
+def working_directory(folder):
+    current_folder = os.getcwd()
+    os.chdir(folder)
+    try:
+        yield folder
+    finally:
+        os.chdir(current_folder)
+
+
+def save_one_by_one(parsers):
+    """ per book loading in SQLite autocommit mode (one transaction per
+        statement), as done before BulkLoader """
+    for parser in parsers:
+        process_parsed_rdf(parser)
+
+
+def count_rows():
+    return sum([model.select().count()
+                for model in (Author, Book, BookFormat, Format, RdfFile)])
+
+
+def catalog_rows():
+    """ {table: sorted rows} of the catalog, formats being referred to by
+        their fields rather than their (insertion order) IDs """
+    format_fields = (Format.mime, Format.images, Format.pattern)
+    return {
+        'author': sorted(Author.select().tuples()),
+        'book': sorted(Book.select().tuples()),
+        'bookformat': sorted(
+            BookFormat.select(BookFormat.book, BookFormat.downloaded_from,
+                              *format_fields)
+                      .join(Format).tuples()),
+        'format': sorted(Format.select(*format_fields).tuples()),
+        'license': sorted(License.select().tuples()),
+        'rdffile': sorted(RdfFile.select().tuples()),
+    }
+
+
+def time_parse(rdf_entries, engine='bs4'):
+    """ timings of RdfParser.parse on rdf_entries (already read) """
+    start = time.time()
+    parsers = [parse_rdf_entry(rdf_entry, engine=engine)
+               for rdf_entry in rdf_entries]
+    duration = time.time() - start
+    return parsers, {'duration': duration,
+                     'files': len(parsers),
+                     'files_per_second': rate(len(parsers), duration)}
+
+
+def time_loader(loader, parsers):
+    """ duration and number of rows written by loader(parsers) on an
+        empty temporary DB """
+    with temporary_database():
+        nb_rows = count_rows()
+        start = time.time()
+        loader(parsers)
+        duration = time.time() - start
+        nb_rows = count_rows() - nb_rows
+
+    return {'duration': duration,
+            'rows': nb_rows,
+            'rows_per_second': rate(nb_rows, duration)}
+
+
+def time_parse_and_fill(rdf_path, engine='bs4', nb_workers=1):
+    """ timings of the whole parse stage, from files to DB """
+    with temporary_database():
+        # fixtures are not written by parse_and_fill
+        nb_rows = count_rows()
+        start = time.time()
+        parse_and_fill(rdf_path=rdf_path, engine=engine,
+                       nb_workers=nb_workers)
+        duration = time.time() - start
+        nb_files = RdfFile.select().count()
+        nb_rows = count_rows() - nb_rows
+
+    return {'duration': duration,
+            'files': nb_files,
+            'rows': nb_rows,
+            'files_per_second': rate(nb_files, duration)}
+
+
+def hot_queries():
+    """ {name: (query, tables which must not be scanned)} of the
+        queries run for each book or language during download & export """
+    book = Book(id=1)
+    return {
+        'filtered_books': (
+            get_list_of_filtered_books(['fr'], ['epub', 'html']),
+            ['bookformat']),
+        'books_by_language': (
+            Book.select(Book.language), []),
+        'popular_books': (
+            Book.select().order_by(Book.downloads.desc()), ['book']),
+        'popular_books_in_language': (
+            Book.select().where(Book.language == 'fr')
+                         .order_by(Book.downloads.desc()), ['book']),
+        'books_in_language_by_title': (
+            Book.select().where(Book.language == 'fr')
+                         .order_by(Book.title.asc()), ['book']),
+        'popular_books_of_author': (
+            Book.select().where(Book.author == '116')
+                         .order_by(Book.downloads.desc()), ['book']),
+        'books_of_author_by_title': (
+            Book.select().where(Book.author == '116')
+                         .order_by(Book.title.asc()), ['book']),
+        'authors_by_name': (
+            Author.select().order_by(Author.last_name.asc(),
+                                     Author.first_names.asc()), ['author']),
+        'formats_of_book': (
+            BookFormat.select(BookFormat, Book, Format)
+                      .join(Book).switch(BookFormat).join(Format)
+                      .where(Book.id == book.id), ['book', 'bookformat']),
+        'book_has_format': (
+            BookFormat.select(BookFormat, Book, Format)
+                      .join(Book).switch(BookFormat).join(Format)
+                      .where(Book.id == book.id)
+                      .where(Format.mime == FORMAT_MATRIX.get('epub')),
+            ['book', 'bookformat', 'format']),
+        'book_formats_by_pattern': (
+            BookFormat.filter(book=book).join(Format)
+                      .filter(Format.pattern << ['{book_id}.epub']),
+            ['bookformat', 'format']),
+        'book_formats_by_mime': (
+            BookFormat.filter(book=book).filter(
+                BookFormat.format << Format.filter(mime='application/pdf')),
+            ['bookformat', 'format']),
+    }
+
+
+def query_plan(query):
+    """ (lines of SQLite's EXPLAIN QUERY PLAN for query,
+         {table alias: table name}) """
+    sql, params = query.sql()
+    aliases = dict([(alias, table) for table, alias
+                    in re.findall(r'"(\w+)" AS (\w+)', sql)])
+    return [row[-1] for row in
+            db.execute_sql('EXPLAIN QUERY PLAN {}'.format(sql), params)], \
+        aliases
+
+
+def scanned_tables(plan, aliases={}):
+    """ tables read in full (without any index) in plan """
+    scanned = [re.match(r'SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$', line)
+               for line in plan]
+    return [aliases.get(match.group(2) or match.group(1), match.group(1))
+            for match in scanned if match is not None]
+
+
+def check_query_plans():
+    """ {query name: [table scanned where an index was expected]} """
+    failures = {}
+    for name, (query, indexed_tables) in sorted(hot_queries().items()):
+        plan, aliases = query_plan(query)
+        scanned = [table for table in scanned_tables(plan, aliases)
+                   if table in indexed_tables]
+        logger.debug("{}: {}".format(name, " | ".join(plan)))
+        if scanned:
+            failures[name] = scanned
+    return failures
+
+
+def check_indexes(database=None):
+    """ logs main queries not using indexes ; True if all do """
+    if database is None:
+        with temporary_database():
+            failures = check_query_plans()
+    else:
+        use_database(database)
+        failures = check_query_plans()
+
+    for name, tables in sorted(failures.items()):
+        logger.error("{} scans table(s) {}".format(name, ", ".join(tables)))
+    if not failures:
+        logger.info("All {} queries use indexes".format(len(hot_queries())))
+    return not failures
+
+
+def benchmark_authors(nb_authors=50000, seed=42):
+    """ {share of authors requested: timings} of authors_from_ids
+        on a DB of nb_authors authors """
+    rand = random.Random(seed)
+    # above ids of fixtures
+    author_ids = [str(author_id)
+                  for author_id in range(1000, 1000 + nb_authors)]
+
+    results = {}
+    with temporary_database():
+        logger.info("Creating {} authors".format(nb_authors))
+        with db.transaction():
+            insert_rows(Author, [
+                {'gut_id': author_id,
+                 'last_name': "{} {}".format(
+                     rand.choice(["Doe", "Dupont", "von Goethe", "Çélèste"]),
+                     rand.randint(1, nb_authors)),
+                 'first_names': rand.choice([None, "John", "Marie-Anne"]),
+                 'birth_year': None,
+                 'death_year': None} for author_id in author_ids])
+
+        for share in (0.01, 0.1, 1):
+            ids = rand.sample(author_ids, int(nb_authors * share))
+            start = time.time()
+            authors = authors_from_ids(ids)
+            duration = time.time() - start
+            results["{:.0%}".format(share)] = {
+                'duration': duration,
+                'authors': len(authors),
+                'authors_per_second': rate(len(authors), duration)}
+    return results
+
+
+def normalized_html(html, epub=False):
+    """ html re-serialized by lxml, so that outputs of both HTML engines
+        can be compared regardless of their serializers """
+    import lxml.html
+    from lxml import etree
+    if epub:
+        tree = etree.fromstring(html, etree.XMLParser(recover=True))
+    else:
+        tree = lxml.html.document_fromstring(html)
+    return etree.tostring(tree, method='c14n')
+
+
+def check_rdf_parsers(rdf_path):
+    """ ({rdf file: [(field, {engine: value})]}, number of files) for the
+        RDF files of rdf_path on which the RDF parser engines disagree """
+    mismatches = {}
+    nb_files = 0
+    for rdf_file, rdf_data in rdf_entries_in_folder(rdf_path):
+        nb_files += 1
+        try:
+            differences = compare_parsers(rdf_data, gid_for(rdf_file))
+        except Exception as e:
+            differences = [('*', {'error': "{}: {}".format(type(e).__name__,
+                                                           e)})]
+        if differences:
+            mismatches[rdf_file] = differences
+    return mismatches, nb_files
+
+
+def check_html_engines(fpaths, epub=False):
+    """ ({fpath: [engine differing from bs4]}, {engine: duration})
+        of update_html_for_static on the HTML files at fpaths """
+    book = Book(id=1, title="Book title", subtitle="", language='en',
+                downloads=0, formats_mask=0, popularity=0,
+                author=Author(gut_id='216', last_name="Anonymous"))
+
+    mismatches = {}
+    durations = dict([(engine, 0) for engine in HTML_UPDATERS.keys()])
+    for fpath in fpaths:
+        with open(fpath, 'r') as f:
+            html_content = f.read()
+
+        outputs = {}
+        for engine in sorted(HTML_UPDATERS.keys()):
+            start = time.time()
+            try:
+                outputs[engine] = update_html_for_static(
+                    book=book, html_content=html_content,
+                    epub=epub, engine=engine)
+            except Exception as e:
+                outputs[engine] = type(e).__name__
+            durations[engine] += time.time() - start
+
+        def normalized(output):
+            try:
+                return normalized_html(output, epub=epub)
+            except Exception:
+                return output
+
+        reference = normalized(outputs.pop('bs4'))
+        differing = [engine for engine, output in sorted(outputs.items())
+                     if normalized(output) != reference]
+        if differing:
+            mismatches[fpath] = differing
+    return mismatches, durations
+
+
+class MirrorRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    """ serves the files of server.root, after server.delay seconds """
+
+    # keep-alive connections, without waiting for ACKs between the
+    # (unbuffered) writes of a response
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def translate_path(self, url_path):
+        url_path = posixpath.normpath(urlparse.urlparse(url_path).path)
+        return os.path.join(self.server.root,
+                            *[part for part in url_path.split('/')
+                              if part not in ('', '.', '..')])
+
+    def counted(self, handler):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight,
+                                            self.server.in_flight)
+        try:
+            time.sleep(self.server.delay)
+            handler(self)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def send_error(self, code, message=None):
+        # keep the connection alive, as mirrors do
+        self.send_response(code, message)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.counted(SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET)
+
+    def do_HEAD(self):
+        self.counted(SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD)
+
+    def log_message(self, *args):
+        pass
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """ local mirror recording the number of connections and the max
+        number of requests in flight """
+
+    daemon_threads = True
+
+    def __init__(self, root, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           MirrorRequestHandler)
+        self.root = root
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.server_address[1])
+
+
+@contextmanager
+def local_mirrors(root, delay=0):
+    """ two MirrorServer serving root, used as the bases of UrlBuilder:
+        downloads are spread on two hosts as they are on the real mirror """
+    servers = [MirrorServer(root, delay=delay) for _ in range(2)]
+    threads = [threading.Thread(target=server.serve_forever)
+               for server in servers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    bases = (UrlBuilder.BASE_ONE, UrlBuilder.BASE_TWO, UrlBuilder.BASE_THREE)
+    UrlBuilder.BASE_ONE = servers[0].url
+    UrlBuilder.BASE_TWO = servers[1].url + 'cache/generated/'
+    UrlBuilder.BASE_THREE = servers[0].url + 'etext'
+    try:
+        yield servers
+    finally:
+        UrlBuilder.BASE_ONE, UrlBuilder.BASE_TWO, UrlBuilder.BASE_THREE = \
+            bases
+        # drop connections kept alive to the servers
+        http_session().close()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def write_mirror(mirror_path, download_cache, rand):
+    """ {file path in download_cache: file path in mirror_path} of the files
+        the download stage will look for, written in mirror_path at the
+        URL tried last """
+    expected = {}
+    for job in download_jobs(download_cache):
+        # ZIP files would need to be valid archives
+        urls = [url for url in job.urls if not url.endswith('.zip')]
+        if not urls:
+            continue
+        mirror_fpath = os.path.join(
+            mirror_path, *urlparse.urlparse(urls[-1]).path.split('/'))
+        path(mirror_fpath).parent.makedirs_p()
+        path(mirror_fpath).write_bytes(
+            os.urandom(rand.randint(1, 64) * 1024))
+        expected[job.fpath] = mirror_fpath
+    return expected
+
+
+def benchmark_downloads(nb_books=1000, seed=42, nb_workers=1,
+                        downloads_per_host=DOWNLOADS_PER_HOST, delay=0.05):
+    """ timings and checks of download_all_books on a synthetic catalog
+        served by local mirrors """
+    rdf_path = os.path.join(
+        TMP_FOLDER, "bench-rdf-{}-{}".format(nb_books, seed))
+    if not path(rdf_path).exists():
+        generate_catalog(rdf_path, nb_books=nb_books, seed=seed)
+
+    work_path = tempfile.mkdtemp(dir=TMP_FOLDER)
+    mirror_path = os.path.join(work_path, 'mirror')
+    download_cache = os.path.join(work_path, 'dl-cache')
+    try:
+        with temporary_database():
+            parse_and_fill(rdf_path=rdf_path)
+            with local_mirrors(mirror_path, delay=delay) as servers:
+                expected = write_mirror(mirror_path, download_cache,
+                                        random.Random(seed))
+                logger.info("Downloading {} files from local mirrors"
+                            .format(len(expected)))
+                start = time.time()
+                download_all_books(url_mirror=servers[0].url,
+                                   download_cache=download_cache,
+                                   nb_workers=nb_workers,
+                                   downloads_per_host=downloads_per_host)
+                duration = time.time() - start
+
+            # downloaded files must be saved as such, to not be retried
+            nb_saved = BookFormat.select().where(
+                BookFormat.downloaded_from != None).count()
+
+        missing = sorted([fpath for fpath, mirror_fpath in expected.items()
+                          if not path(fpath).exists() or
+                          path(fpath).bytes() != path(mirror_fpath).bytes()])
+    finally:
+        path(work_path).rmtree_p()
+
+    return {'duration': duration,
+            'files': len(expected),
+            'files_per_second': rate(len(expected), duration),
+            'missing': missing,
+            'saved': nb_saved,
+            'max_in_flight': [server.max_in_flight for server in servers],
+            'connections': sum([server.connections for server in servers]),
+            'requests': sum([server.requests for server in servers])}
+
+
+def benchmark_stream(nb_books=1000, seed=42, nb_workers=1):
+    """ timings and checks of parse_and_fill on the URL of a synthetic
+        rdf-files.tar.bz2 served by a local mirror """
+    rdf_path = os.path.abspath(os.path.join(
+        TMP_FOLDER, "bench-rdf-{}-{}".format(nb_books, seed)))
+    if not path(rdf_path).exists():
+        generate_catalog(rdf_path, nb_books=nb_books, seed=seed)
+
+    work_path = os.path.abspath(tempfile.mkdtemp(dir=TMP_FOLDER))
+    mirror_path = os.path.join(work_path, 'mirror')
+    served_tarball = os.path.join(mirror_path, RDF_TARBALL)
+    path(mirror_path).mkdir_p()
+    try:
+        write_tarball(rdf_path, served_tarball)
+
+        logger.info("Parsing {} as reference".format(rdf_path))
+        with temporary_database():
+            parse_and_fill(rdf_path=rdf_path)
+            expected = catalog_rows()
+
+        with local_mirrors(mirror_path) as servers, temporary_database():
+            rdf_url = servers[0].url + RDF_TARBALL
+            logger.info("Streaming {}".format(rdf_url))
+            # the streamed tarball is saved in the current directory
+            with working_directory(work_path):
+                start = time.time()
+                parse_and_fill(rdf_path=rdf_url, nb_workers=nb_workers)
+                duration = time.time() - start
+            rows = catalog_rows()
+
+        saved_tarball = path(os.path.join(work_path, RDF_TARBALL))
+        tarball_saved = saved_tarball.exists() and \
+            saved_tarball.bytes() == path(served_tarball).bytes()
+    finally:
+        path(work_path).rmtree_p()
+
+    differences = {}
+    for table in sorted(expected.keys()):
+        missing = set(expected[table]) - set(rows[table])
+        unexpected = set(rows[table]) - set(expected[table])
+        if missing or unexpected:
+            differences[table] = {'missing': len(missing),
+                                  'unexpected': len(unexpected)}
+
+    return {'duration': duration,
+            'files': len(rows['rdffile']),
+            'files_per_second': rate(len(rows['rdffile']), duration),
+            'differences': differences,
+            'tarball_saved': tarball_saved}
+
+
+def benchmark_loaders(rdf_path, engine='bs4'):
+    """ {loader name: timings} for loading RDF files from rdf_path """
+    logger.info("Parsing RDF files from {}".format(rdf_path))
+    parsers, _ = time_parse(rdf_entries_in_folder(rdf_path), engine=engine)
+
+    results = {}
+    for name, loader in (('autocommit', save_one_by_one),
+                         ('bulk', process_parsed_rdfs)):
+        logger.info("Loading {} books with {} loader"
+                    .format(len(parsers), name))
+        results[name] = time_loader(loader, parsers)
+    return results
+
+
+def benchmark_parse_stage(rdf_path, engine='bs4', nb_workers=1):
+    """ results of all parse stage benchmarks on rdf_path """
+    rdf_entries = list(rdf_entries_in_folder(rdf_path))
+    logger.info("Timing RdfParser.parse on {} files".format(len(rdf_entries)))
+    parsers, parse_results = time_parse(rdf_entries, engine=engine)
+    del rdf_entries
+
+    results = {'parse': parse_results}
+    for name, loader in (('save_autocommit', save_one_by_one),
+                         ('save_bulk', process_parsed_rdfs)):
+        logger.info("Timing {}".format(name))
+        results[name] = time_loader(loader, parsers)
+    del parsers
+
+    logger.info("Timing parse_and_fill")
+    results['parse_and_fill'] = time_parse_and_fill(
+        rdf_path, engine=engine, nb_workers=nb_workers)
+    return results
+
+
+def run(rdf_path=None, nb_books=1000, seed=42,
+        engine='bs4', nb_workers=1, output=None):
+    if rdf_path is None:
+        rdf_path = os.path.join(
+            TMP_FOLDER, "bench-rdf-{}-{}".format(nb_books, seed))
+        if not path(rdf_path).exists():
+            generate_catalog(rdf_path, nb_books=nb_books, seed=seed)
+        catalog = {'synthetic': True, 'nb_books': nb_books, 'seed': seed}
+    else:
+        catalog = {'synthetic': False, 'path': rdf_path}
+
+    report = {
+        'version': RESULTS_VERSION,
+        'created_on': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'catalog': catalog,
+        'engine': engine,
+        'nb_workers': nb_workers,
+        'results': benchmark_parse_stage(rdf_path, engine=engine,
+                                         nb_workers=nb_workers),
+    }
+
+    for name, result in sorted(report['results'].items()):
+        logger.info("{name}: {duration:.2f}s {details}".format(
+            name=name, duration=result['duration'],
+            details=", ".join(["{}={:.0f}".format(k, v)
+                               for k, v in sorted(result.items())
+                               if k != 'duration'])))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        logger.info("Results written to {}".format(output))
+    return report
+
+
+def compare(before, after):
+    """ logs duration change of each benchmark between two result files """
+    with open(before, 'r') as f:
+        before = json.load(f)
+    with open(after, 'r') as f:
+        after = json.load(f)
+
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old = before['results'][name]['duration']
+        new = after['results'][name]['duration']
+        logger.info("{name}: {old:.2f}s -> {new:.2f}s ({change:+.1f}%)"
+                    .format(name=name, old=old, new=new,
+                            change=(new - old) / old * 100 if old else 0))
+
+
+def main(arguments):
+    # keep the gutenberg.db file untouched
+    path(TMP_FOLDER).mkdir_p()
+    current_db = db.database
+
+    engine = arguments.get('--rdf-parser') or 'bs4'
+    nb_books = int(arguments.get('--scale') or 1000)
+    seed = int(arguments.get('--seed') or 42)
+
+    if arguments.get('generate'):
+        generate_catalog(arguments.get('<rdf_folder>'),
+                         nb_books=nb_books, seed=seed)
+
+    if arguments.get('run'):
+        run(rdf_path=arguments.get('<rdf_folder>'),
+            nb_books=nb_books, seed=seed, engine=engine,
+            nb_workers=int(arguments.get('--parse-workers') or 1),
+            output=arguments.get('--output'))
+
+    if arguments.get('loaders'):
+        results = benchmark_loaders(
+            rdf_path=arguments.get('<rdf_folder>'), engine=engine)
+        for name, result in sorted(results.items()):
+            logger.info("{name}: {rows} rows in {duration:.2f}s "
+                        "({rows_per_second:.0f} rows/s)"
+                        .format(name=name, **result))
+
+    if arguments.get('parsers'):
+        rdf_path = arguments.get('<rdf_folder>')
+        if rdf_path is None:
+            rdf_path = os.path.join(
+                TMP_FOLDER, "bench-rdf-{}-{}".format(nb_books, seed))
+            if not path(rdf_path).exists():
+                generate_catalog(rdf_path, nb_books=nb_books, seed=seed)
+        mismatches, nb_files = check_rdf_parsers(rdf_path)
+        logger.info("{} RDF files checked, {} differ between engines"
+                    .format(nb_files, len(mismatches)))
+        for rdf_file, differences in sorted(mismatches.items()):
+            for field, values in differences:
+                logger.error("{}: {} differs: {}"
+                             .format(rdf_file, field, values))
+        if mismatches or not nb_files:
+            use_database(current_db)
+            sys.exit(1)
+
+    if arguments.get('compare'):
+        compare(arguments.get('<before>'), arguments.get('<after>'))
+
+    if arguments.get('authors'):
+        results = benchmark_authors(
+            nb_authors=int(arguments.get('--authors') or 50000), seed=seed)
+        for name, result in sorted(results.items()):
+            logger.info("{name} of authors: {authors} in {duration:.2f}s "
+                        "({authors_per_second:.0f} authors/s)"
+                        .format(name=name, **result))
+
+    if arguments.get('html'):
+        if arguments.get('<html_file>'):
+            fpaths = {bool(arguments.get('--epub')):
+                      arguments.get('<html_file>')}
+        else:
+            fpaths = generate_html_fixtures(
+                os.path.join(TMP_FOLDER, "bench-html"))
+        mismatches = {}
+        for epub, mode_fpaths in sorted(fpaths.items()):
+            mode_mismatches, durations = check_html_engines(mode_fpaths,
+                                                            epub=epub)
+            mismatches.update(mode_mismatches)
+            for engine, duration in sorted(durations.items()):
+                logger.info("{}{}: {} files in {:.2f}s"
+                            .format(engine, " (ePUB)" if epub else "",
+                                    len(mode_fpaths), duration))
+        for fpath, engines in sorted(mismatches.items()):
+            logger.error("{}: {} output differs from bs4"
+                         .format(fpath, ", ".join(engines)))
+        if len(HTML_UPDATERS) < 2:
+            logger.error("lxml is not installed: no engine to compare "
+                         "bs4 with")
+        if mismatches or len(HTML_UPDATERS) < 2:
+            use_database(current_db)
+            sys.exit(1)
+
+    if arguments.get('download'):
+        downloads_per_host = int(arguments.get('--downloads-per-host') or
+                                 DOWNLOADS_PER_HOST)
+        results = benchmark_downloads(
+            nb_books=nb_books, seed=seed,
+            nb_workers=int(arguments.get('--download-workers') or 1),
+            downloads_per_host=downloads_per_host,
+            delay=float(arguments.get('--delay') or 0.05))
+        logger.info("{files} files in {duration:.2f}s "
+                    "({files_per_second:.1f} files/s), {saved} saved to DB, "
+                    "{requests} requests on {connections} connections, "
+                    "max requests in flight per host: {max_in_flight}"
+                    .format(**results))
+        errors = ["{} not downloaded".format(fpath)
+                  for fpath in results['missing']]
+        if results['saved'] != results['files']:
+            errors.append("{} downloaded files saved to DB"
+                          .format(results['saved']))
+        if max(results['max_in_flight']) > downloads_per_host:
+            errors.append("more than {} requests in flight to a host"
+                          .format(downloads_per_host))
+        for error in errors:
+            logger.error(error)
+        if errors:
+            use_database(current_db)
+            sys.exit(1)
+
+    if arguments.get('stream'):
+        results = benchmark_stream(
+            nb_books=nb_books, seed=seed,
+            nb_workers=int(arguments.get('--parse-workers') or 1))
+        logger.info("{files} RDF files streamed in {duration:.2f}s "
+                    "({files_per_second:.1f} files/s)".format(**results))
+        errors = ["{table}: {missing} rows missing, {unexpected} unexpected "
+                  "rows compared to the extracted folder"
+                  .format(table=table, **counts)
+                  for table, counts in sorted(results['differences'].items())]
+        if not results['files']:
+            errors.append("no RDF file parsed")
+        if not results['tarball_saved']:
+            errors.append("saved {} differs from the served one"
+                          .format(RDF_TARBALL))
+        for error in errors:
+            logger.error(error)
+        if errors:
+            use_database(current_db)
+            sys.exit(1)
+
+    if arguments.get('indexes'):
+        if not check_indexes(arguments.get('<database>')):
+            use_database(current_db)
+            sys.exit(1)
+
+    use_database(current_db)
+
+
+if __name__ == '__main__':
+    main(docopt(help, version=0.1))
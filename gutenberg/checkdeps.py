@@ -30,9 +30,7 @@ def check_dependencies():
         'pngquant': "PNG compression tool, part of `pngquant` package",
         'advdef': "PNG compression tool, part of `advancecomp` package",
         'jpegoptim': "JPEG compression tool, part of `jpegoptim` package",
-        'zip': "ZIP file packager for ePub",
         'tar': "TAR archive extractor",
-        'curl': "Files downloader, part of `curl` package",
         'zimwriterfs': "ZIM file writer, available on kiwix-other repository",
     }
 
@@ -14,6 +14,9 @@ from gutenberg import logger
 db = SqliteDatabase('gutenberg.db')
 db.connect()
 
+# max number of `?` parameters in a single SQLite statement
+SQLITE_MAX_VARIABLES = 999
+
 
 class License(Model):
 
@@ -37,9 +40,9 @@ class Format(Model):
     class Meta:
         database = db
 
-    mime = CharField(max_length=100)
+    mime = CharField(max_length=100, index=True)
     images = BooleanField(default=True)
-    pattern = CharField(max_length=100)
+    pattern = CharField(max_length=100, index=True)
 
     def __unicode__(self):
         return self.mime
@@ -49,6 +52,9 @@ class Author(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('last_name', 'first_names'), False),
+        )
         fixtures = [
             {
                 'gut_id': '116',
@@ -104,16 +110,24 @@ class Book(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('language', 'downloads'), False),
+            (('language', 'title'), False),
+            (('author', 'downloads'), False),
+        )
 
     id = IntegerField(primary_key=True)
-    title = CharField(max_length=500)
+    title = CharField(max_length=500, index=True)
     subtitle = CharField(max_length=500, null=True)
     author = ForeignKeyField(Author, related_name='books')
     license = ForeignKeyField(License, related_name='books')
     language = CharField(max_length=10)
-    downloads = IntegerField(default=0)
-
-    popularity = 0
+    downloads = IntegerField(default=0, index=True)
+    # main formats (html, epub, pdf) of the book's BookFormat, as bits
+    # of utils.FORMAT_BITS. Kept in sync when writing BookFormat.
+    formats_mask = IntegerField(default=0)
+    # number of stars, computed on export
+    popularity = IntegerField(default=0)
 
     def __unicode__(self):
         return "{}/{}".format(self.id, self.title)
@@ -143,14 +157,17 @@ class Book(Model):
         ]
 
     def formats(self):
-        from gutenberg.utils import main_formats_for
-        return main_formats_for(self)
+        from gutenberg.utils import formats_from_mask
+        return formats_from_mask(self.formats_mask)
 
 
 class BookFormat(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('book', 'format'), False),
+        )
 
     book = ForeignKeyField(Book, related_name='bookformats')
     format = ForeignKeyField(Format, related_name='bookformats')
@@ -160,6 +177,75 @@ class BookFormat(Model):
         return "[{}] {}".format(self.format, self.book.title)
 
 
+class RdfFile(Model):
+
+    """ checksum of the RDF file each book was last parsed from """
+
+    class Meta:
+        database = db
+
+    gid = IntegerField(primary_key=True)
+    checksum = CharField(max_length=32)
+
+    def __unicode__(self):
+        return "{}/{}".format(self.gid, self.checksum)
+
+
+class ParseFilters(Model):
+
+    """ languages and formats (comma-separated) the catalog was last
+        parsed with, as a single row """
+
+    class Meta:
+        database = db
+
+    languages = CharField(max_length=500)
+    formats = CharField(max_length=100)
+
+    def __unicode__(self):
+        return "{}/{}".format(self.languages, self.formats)
+
+
+class ExportedBook(Model):
+
+    """ checksum of what each book was last exported from """
+
+    class Meta:
+        database = db
+
+    book = IntegerField(primary_key=True)
+    checksum = CharField(max_length=32)
+
+    def __unicode__(self):
+        return "{}/{}".format(self.book, self.checksum)
+
+
+MODELS = (License, Format, Author, Book, BookFormat, RdfFile, ParseFilters,
+          ExportedBook)
+
+
+def use_database(fpath):
+    """ point all models to the SQLite DB at fpath instead """
+    if not db.is_closed():
+        db.close()
+    db.init(fpath)
+    db.connect()
+
+
+def insert_rows(model, rows, upsert=False):
+    """ multi-rows INSERT of rows (list of dicts), in as few statements
+        as SQLite's parameters limit allows """
+    if not rows:
+        return
+
+    chunk_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    for start in range(0, len(rows), chunk_size):
+        query = model.insert_many(rows[start:start + chunk_size])
+        if upsert:
+            query = query.upsert()
+        query.execute()
+
+
 def load_fixtures(model):
     logger.info("Loading fixtures for {}".format(model._meta.name))
 
@@ -168,10 +254,87 @@ def load_fixtures(model):
         logger.debug("[fixtures] Created {}".format(f))
 
 
+def declared_indexes(model):
+    """ {index name: ([field], unique)} of all indexes declared on model,
+        named as peewee names them on table creation """
+    compiler = model._meta.database.compiler()
+    indexes = [([field], field.unique) for field in model._fields_to_index()]
+    indexes += [([model._meta.fields[name] for name in field_names], unique)
+                for field_names, unique in model._meta.indexes]
+    return dict([(compiler.index_name(model._meta.db_table,
+                                      [field.db_column for field in fields]),
+                  (fields, unique))
+                 for fields, unique in indexes])
+
+
+def add_column(model, field):
+    """ ALTER TABLE to add field's column to model's existing table """
+    compiler = db.compiler()
+    definition, _ = compiler.parse_node(compiler.field_definition(field))
+    if field.default is not None:
+        # SQLite refuses to add a NOT NULL column without default
+        default = field.db_value(field.default)
+        if isinstance(default, basestring):
+            default = "'{}'".format(default.replace("'", "''"))
+        definition += ' DEFAULT {}'.format(default)
+    db.execute_sql('ALTER TABLE "{table}" ADD COLUMN {definition}'
+                   .format(table=model._meta.db_table, definition=definition))
+
+
+def update_formats_masks():
+    """ recomputes Book.formats_mask of all books from their BookFormat """
+    from gutenberg.utils import FORMAT_MATRIX, FORMAT_BITS
+    with db.transaction():
+        Book.update(formats_mask=0).execute()
+        for fmt, mime in FORMAT_MATRIX.items():
+            with_format = BookFormat.select(BookFormat.book) \
+                                    .join(Format) \
+                                    .where(Format.mime == mime)
+            Book.update(formats_mask=Book.formats_mask + FORMAT_BITS[fmt]) \
+                .where(Book.id << with_format).execute()
+
+
+def migrate_database():
+    """ brings the schema of an existing DB up to date with the models:
+        adds the tables, columns and indexes it lacks """
+    created = False
+    for model in MODELS:
+        if not model.table_exists():
+            logger.info("Creating table {}".format(model._meta.db_table))
+            model.create_table()
+            load_fixtures(model)
+            continue
+
+        columns = set([row[1] for row in db.execute_sql(
+            'PRAGMA table_info("{}")'.format(model._meta.db_table))])
+        for field in model._meta.get_fields():
+            if field.db_column in columns:
+                continue
+            logger.info("Adding column {}.{}"
+                        .format(model._meta.db_table, field.db_column))
+            add_column(model, field)
+            if field is Book.formats_mask:
+                update_formats_masks()
+
+        # peewee's get_indexes_for_table() is broken for SQLite
+        existing = set([row[1] for row in db.execute_sql(
+            'PRAGMA index_list("{}")'.format(model._meta.db_table))])
+        for name, (fields, unique) in sorted(declared_indexes(model).items()):
+            if name in existing:
+                continue
+            logger.info("Creating index {}".format(name))
+            db.create_index(model, fields, unique)
+            created = True
+
+    if created:
+        # let the query planner know about the new indexes
+        db.execute_sql('ANALYZE')
+
+
 def setup_database(wipe=False):
     logger.info("Setting up the database")
 
-    for model in (License, Format, Author, Book, BookFormat):
+    for model in MODELS:
         if wipe:
             model.drop_table(fail_silently=True)
         if not model.table_exists():
@@ -180,3 +343,5 @@ def setup_database(wipe=False):
             load_fixtures(model)
         else:
             logger.debug("{} table already exists.".format(model._meta.name))
+
+    migrate_database()
@@ -5,8 +5,14 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import os
-import tempfile
 import zipfile
+import urlparse
+import tempfile
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import requests
 from path import path
@@ -15,11 +21,48 @@ from gutenberg import logger, TMP_FOLDER
 from gutenberg.urls import get_urls
 from gutenberg.database import BookFormat, Format
 from gutenberg.export import get_list_of_filtered_books, fname_for
-from gutenberg.utils import download_file, FORMAT_MATRIX
+from gutenberg.utils import (download_file, http_session, companion_fname,
+                             FORMAT_MATRIX, HTTP_TIMEOUT)
+
+# max number of requests in flight to a single host, whatever the number of
+# workers: mirrors throttle (or ban) clients opening too many connections.
+DOWNLOADS_PER_HOST = 4
+
+# a file of a book to download from the first working URL of urls
+DownloadJob = namedtuple('DownloadJob',
+                         ['book', 'format', 'fpath', 'book_format', 'urls'])
+
+
+class ConnectionLimiter(object):
+
+    """ caps the number of requests in flight to each host """
+
+    def __init__(self, max_per_host=DOWNLOADS_PER_HOST):
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore_for(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self.semaphores[host]
+
+    @contextmanager
+    def slot_for(self, url):
+        """ blocks until a request to url's host can be made """
+        with self.semaphore_for(urlparse.urlparse(url).netloc):
+            yield
 
 
-def resource_exists(url):
-    r = requests.get(url, stream=True)
+def resource_exists(url, timeout=HTTP_TIMEOUT):
+    # body is not needed: don't have the mirror send it
+    try:
+        r = http_session().head(url, allow_redirects=True, timeout=timeout)
+    except requests.RequestException as e:
+        logger.debug("\t\tUnable to reach {}: {}".format(url, e))
+        return False
     return r.status_code == requests.codes.ok
 
 
@@ -77,15 +120,13 @@ def handle_zipped_epub(zippath,
                                        "{bid}.html".format(bid=book.id))
                 else:
                     dst = os.path.join(download_cache,
-                               "{bid}_{fname}".format(bid=book.id,
-                                                      fname=fname))
+                                       companion_fname(book.id, fname))
             else:
                 dst = os.path.join(download_cache,
                                    "{bid}.html".format(bid=book.id))
         else:
             dst = os.path.join(download_cache,
-                               "{bid}_{fname}".format(bid=book.id,
-                                                      fname=fname))
+                               companion_fname(book.id, fname))
         try:
             path(src).move(dst)
         except Exception as e:
@@ -100,29 +141,78 @@ def handle_zipped_epub(zippath,
 
 def download_all_books(url_mirror, download_cache,
                        languages=[], formats=[],
-                       only_books=[], force=False):
+                       only_books=[], force=False,
+                       nb_workers=1, downloads_per_host=DOWNLOADS_PER_HOST,
+                       timeout=HTTP_TIMEOUT):
+    """ downloads the files of all (filtered) books to download_cache,
+        nb_workers files at a time with at most downloads_per_host
+        requests to a single host, through a shared pool of connections.
+
+        Working URLs are saved to DB in the order of books, as
+        downloads complete. """
+
+    # ensure dir exist
+    path(download_cache).mkdir_p()
+
+    # list of files to download, built upfront as workers can't use the DB
+    jobs = download_jobs(download_cache=download_cache,
+                         languages=languages, formats=formats,
+                         only_books=only_books, force=force)
+
+    limiter = ConnectionLimiter(downloads_per_host)
+
+    def download_in_worker(job):
+        return download_book_file(job, download_cache, limiter,
+                                  timeout=timeout)
+
+    if nb_workers > 1:
+        logger.info("\tDownloading {} files with {} workers"
+                    .format(len(jobs), nb_workers))
+        pool = ThreadPool(nb_workers)
+        results = pool.imap(download_in_worker, jobs)
+    else:
+        pool = None
+        results = itertools.imap(download_in_worker, jobs)
+
+    try:
+        for job, url in itertools.izip(jobs, results):
+            if url is None:
+                logger.error("NO FILE FOR #{}/{}"
+                             .format(job.book.id, job.format))
+                continue
+
+            # store working URL in DB
+            if job.book_format.downloaded_from != url:
+                job.book_format.downloaded_from = url
+                job.book_format.save()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def download_jobs(download_cache, languages=[], formats=[],
+                  only_books=[], force=False):
+    """ [DownloadJob] of the book files missing from download_cache """
 
     available_books = get_list_of_filtered_books(
         languages=languages,
         formats=formats,
         only_books=only_books)
 
-    # ensure dir exist
-    path(download_cache).mkdir_p()
+    # apply filters
+    formats = list(formats or FORMAT_MATRIX.keys())
+
+    # HTML is our base for ZIM for add it if not present
+    if not 'html' in formats:
+        formats.append('html')
 
+    jobs = []
     for book in available_books:
 
-        logger.info("\tDownloading content files for Book #{id}"
+        logger.info("\tListing content files for Book #{id}"
                     .format(id=book.id))
 
-        # apply filters
-        if not formats:
-            formats = FORMAT_MATRIX.keys()
-
-        # HTML is our base for ZIM for add it if not present
-        if not 'html' in formats:
-            formats.append('html')
-
         for format in formats:
 
             fpath = os.path.join(download_cache, fname_for(book, format))
@@ -176,38 +266,41 @@ def download_all_books(url_mirror, download_cache,
                 urls = [bf.downloaded_from]
             else:
                 urld = get_urls(book)
-                urls = list(reversed(urld.get(FORMAT_MATRIX.get(format))))
+                urls = urld.get(FORMAT_MATRIX.get(format)) or []
 
-            import copy
-            allurls = copy.copy(urls)
+            jobs.append(DownloadJob(book=book, format=format, fpath=fpath,
+                                    book_format=bf, urls=urls))
+    return jobs
 
-            while(urls):
-                url = urls.pop()
 
-                if not resource_exists(url):
-                    continue
+def download_book_file(job, download_cache, limiter, timeout=HTTP_TIMEOUT):
+    """ downloads job's file from the first of its URLs that works.
 
-                # HTML files are *sometime* available as ZIP files
-                if url.endswith('.zip'):
-                    zpath = "{}.zip".format(fpath)
+        Returns that URL, None if none worked. Runs in worker threads:
+        must not use the DB. """
+    for url in job.urls:
 
-                    if not download_file(url, zpath):
-                        logger.error("ZIP file donwload failed: {}".format(zpath))
-                        continue
+        with limiter.slot_for(url):
+            if not resource_exists(url, timeout=timeout):
+                continue
 
-                    # extract zipfile
-                    handle_zipped_epub(zippath=zpath, book=book,
-                                       download_cache=download_cache)
-                else:
-                    if not download_file(url, fpath):
-                        logger.error("file donwload failed: {}".format(fpath))
-                        continue
+            # HTML files are *sometime* available as ZIP files
+            if url.endswith('.zip'):
+                zpath = "{}.zip".format(job.fpath)
 
-                # store working URL in DB
-                bf.downloaded_from = url
-                bf.save()
+                if not download_file(url, zpath, timeout=timeout):
+                    logger.error("ZIP file donwload failed: {}"
+                                 .format(zpath))
+                    continue
+            else:
+                if not download_file(url, job.fpath, timeout=timeout):
+                    logger.error("file donwload failed: {}"
+                                 .format(job.fpath))
+                    continue
 
-            if not bf.downloaded_from:
-                logger.error("NO FILE FOR #{}/{}".format(book.id, format))
-                from pprint import pprint as pp ; pp(allurls)
-                continue
+        if url.endswith('.zip'):
+            # extract zipfile
+            handle_zipped_epub(zippath=zpath, book=job.book,
+                               download_cache=download_cache)
+        return url
+    return None
@@ -5,23 +5,32 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import os
+import re
 import json
+import hashlib
 import zipfile
-import tempfile
 import urllib
+import multiprocessing
 
 import bs4
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 from path import path
 from jinja2 import Environment, PackageLoader
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
 
 import gutenberg
-from gutenberg import logger, XML_PARSER, TMP_FOLDER
-from gutenberg.utils import (FORMAT_MATRIX, main_formats_for,
-                             get_list_of_filtered_books, exec_cmd, cd,
+from gutenberg import logger, XML_PARSER
+from gutenberg.utils import (get_list_of_filtered_books,
                              get_langs_with_count, get_lang_groups,
-                             is_bad_cover, path_for_cmd)
-from gutenberg.database import Book, Format, BookFormat, Author
+                             is_bad_cover, link_or_copy, LogCollector,
+                             companion_files_index, tree_checksum)
+from gutenberg.database import (db, use_database, insert_rows, Book, Author,
+                                ExportedBook, SQLITE_MAX_VARIABLES)
+from gutenberg.images import (optimize_images, optimized_images_data,
+                              check_tools)
 from gutenberg.iso639 import language_name
 from gutenberg.l10n import l10n_strings
 
@@ -31,13 +40,26 @@ DEBUG_COUNT = []
 
 NB_POPULARITY_STARS = 5
 
+# state of an export worker process, set by init_export_worker()
+EXPORT_WORKER = {}
+
+# {(SQL, params) of books query: default context for those books}
+DEFAULT_CONTEXTS = {}
+
 
 def get_default_context(books):
-    return {
-        'l10n_strings': json.dumps(l10n_strings),
-        'ui_languages': ['en', 'fr'],
-        'languages': get_langs_with_count(books=books),
-    }
+    """ context shared by all pages of books, built once per books query.
+
+        Returns a copy: callers may add keys but not alter shared values """
+    sql, params = books.sql()
+    key = (sql, tuple(params))
+    if key not in DEFAULT_CONTEXTS:
+        DEFAULT_CONTEXTS[key] = {
+            'l10n_strings': json.dumps(l10n_strings),
+            'ui_languages': ('en', 'fr'),
+            'languages': tuple(get_langs_with_count(books=books)),
+        }
+    return dict(DEFAULT_CONTEXTS[key])
 
 
 def fa_for_format(format):
@@ -71,11 +93,73 @@ def get_list_of_all_languages():
     return list(set(list([b.language for b in Book.select(Book.language)])))
 
 
+def popularity_limits(downloads):
+    """ minimum number of downloads to get each star (index 0 is the
+        first star), from all downloads counts sorted in descending order """
+    stars_limits = [0] * NB_POPULARITY_STARS
+    stars = NB_POPULARITY_STARS
+    nb_books = len(downloads)
+    nb_downloads = downloads[0] if downloads else 0
+    for ibook, book_downloads in enumerate(downloads):
+        if ibook > float(NB_POPULARITY_STARS-stars+1)/NB_POPULARITY_STARS*nb_books \
+           and book_downloads < nb_downloads:
+            stars_limits[stars-1] = nb_downloads
+            stars = stars - 1
+        nb_downloads = book_downloads
+    return stars_limits
+
+
+def popularity_for(downloads, stars_limits):
+    return sum([int(downloads >= limit) for limit in stars_limits])
+
+
+def compute_popularity(books, by_language=False):
+    """ stores Book.popularity (number of stars) of books, ranked against
+        each other or, if by_language, against books in the same language """
+    # (id, downloads, language) of books, most downloaded first
+    ranked = {}
+    for book_id, downloads, language in \
+            books.select(Book.id, Book.downloads, Book.language) \
+                 .order_by(Book.downloads.desc()).tuples():
+        ranked.setdefault(language if by_language else None, []) \
+              .append((book_id, downloads))
+
+    # {number of stars: [book id]}
+    book_ids = {}
+    for group in ranked.values():
+        stars_limits = popularity_limits([downloads
+                                          for _, downloads in group])
+        for book_id, downloads in group:
+            book_ids.setdefault(popularity_for(downloads, stars_limits), []) \
+                    .append(book_id)
+
+    with db.transaction():
+        for popularity, ids in book_ids.items():
+            for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                Book.update(popularity=popularity) \
+                    .where(Book.id << ids[start:start + SQLITE_MAX_VARIABLES]) \
+                    .execute()
+
+
 def export_all_books(static_folder,
                      download_cache,
                      languages=[],
                      formats=[],
-                     only_books=[]):
+                     only_books=[],
+                     popularity_by_language=False,
+                     nb_workers=1,
+                     html_engine='bs4',
+                     incremental=False,
+                     link_mode='copy'):
+    """ exports books to static_folder, along with JSON helpers and assets
+
+        incremental only exports books which files in download_cache or
+        metadata changed since their last export (see export_checksum()).
+        Cover pages depend on the whole collection and are always exported.
+
+        link_mode is how files exported unmodified (PDF…) are put in
+        static_folder (see utils.link_or_copy()).
+        Returns {book id: error message} of books which failed """
 
     # ensure dir exist
     path(static_folder).mkdir_p()
@@ -84,17 +168,17 @@ def export_all_books(static_folder,
                                        formats=formats,
                                        only_books=only_books)
 
+    # books in DB might have changed since a previous export
+    DEFAULT_CONTEXTS.clear()
+
+    # Compute popularity
+    compute_popularity(books, by_language=popularity_by_language)
+
     sz = len(list(books))
     logger.debug("\tFiltered book collection size: {}".format(sz))
 
     def nb_by_fmt(fmt):
-        return sum([1 for book in books
-                    if BookFormat.select(BookFormat, Book, Format)
-                                 .join(Book).switch(BookFormat)
-                                 .join(Format)
-                                 .where(Book.id == book.id)
-                                 .where(Format.mime == FORMAT_MATRIX.get(fmt))
-                                 .count()])
+        return sum([1 for book in books if fmt in book.formats()])
 
     logger.debug("\tFiltered book collection, PDF: {}"
                  .format(nb_by_fmt('pdf')))
@@ -115,6 +199,8 @@ def export_all_books(static_folder,
                   'jquery-ui', 'datatables', 'fonts', 'l10n'):
         src = os.path.join(src_folder, fname)
         dst = os.path.join(static_folder, fname)
+        if tree_checksum(src) == tree_checksum(dst):
+            continue
         if not path(fname).ext:
             path(dst).rmtree_p()
             path(src).copytree(dst)
@@ -128,31 +214,184 @@ def export_all_books(static_folder,
     with open(os.path.join(static_folder, 'Home.html'), 'w') as f:
         f.write(template.render(**context).encode('utf-8'))
 
-    # Compute popularity
-    popbooks = books.order_by(Book.downloads.desc())
-    stars_limits = [0] * NB_POPULARITY_STARS
-    stars = NB_POPULARITY_STARS
-    nb_downloads = popbooks[0].downloads
-    for ibook in range(0, popbooks.count(), 1):
-        if ibook > float(NB_POPULARITY_STARS-stars+1)/NB_POPULARITY_STARS*popbooks.count() \
-           and popbooks[ibook].downloads < nb_downloads:
-            stars_limits[stars-1] = nb_downloads
-            stars = stars - 1
-        nb_downloads = popbooks[ibook].downloads
+    # missing image tools are reported once, not for every book
+    check_tools()
 
     # export to HTML
-    cached_files = os.listdir(download_cache)
-    for book in books:
-        book.popularity = sum(
-            [int(book.downloads >= stars_limits[i])
-             for i in range(NB_POPULARITY_STARS)])
-        export_book_to(book=book,
-                       static_folder=static_folder,
+    companion_files = companion_files_index(os.listdir(download_cache))
+    export_args = dict(static_folder=static_folder,
                        download_cache=download_cache,
-                       cached_files=cached_files,
+                       companion_files=companion_files,
                        languages=languages,
                        formats=formats,
-                       books=books)
+                       html_engine=html_engine,
+                       link_mode=link_mode,
+                       # images of a book are optimized by threads of
+                       # their own: keep one tool running per CPU overall
+                       image_threads=max(1, multiprocessing.cpu_count() //
+                                         nb_workers))
+
+    # what books are exported from, to skip those which did not change.
+    # exported books only use the infobox template: cover pages, which use
+    # the other templates, are always exported.
+    templates_checksum = tree_checksum(os.path.join(tmpl_path(),
+                                                    'book_infobox.html'))
+    if incremental:
+        exported = dict(ExportedBook.select(ExportedBook.book,
+                                           ExportedBook.checksum).tuples())
+    else:
+        exported = {}
+    checksums = {}
+    books_to_export = []
+    for book in books:
+        checksums[book.id] = export_checksum(
+            book=book, download_cache=download_cache,
+            companion_files=companion_files, formats=formats,
+            html_engine=html_engine, link_mode=link_mode,
+            templates_checksum=templates_checksum)
+        if exported.get(book.id) == checksums[book.id] \
+                and is_exported(book=book, static_folder=static_folder,
+                                download_cache=download_cache,
+                                companion_files=companion_files,
+                                formats=formats):
+            export_cover_to(book=book, static_folder=static_folder,
+                            books=books)
+        else:
+            books_to_export.append(book)
+    if incremental:
+        logger.info("\t{} books up to date, exporting {} books"
+                    .format(sz - len(books_to_export), len(books_to_export)))
+
+    failures = {}
+    if nb_workers > 1:
+        # workers open their own read-only connection
+        db.close()
+        pool = multiprocessing.Pool(
+            nb_workers, initializer=init_export_worker,
+            initargs=(db.database, export_args,
+                      dict(languages=languages, formats=formats,
+                           only_books=only_books)))
+        db.connect()
+        try:
+            # results come in books order: logs are replayed as if serial
+            for book_id, records, error in pool.imap(
+                    export_book_in_worker,
+                    [book.id for book in books_to_export]):
+                for level, message in records:
+                    logger.log(level, message)
+                if error is not None:
+                    failures[book_id] = error
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for book in books_to_export:
+            error = export_book_or_error(book=book, books=books,
+                                         **export_args)
+            if error is not None:
+                failures[book.id] = error
+
+    with db.transaction():
+        insert_rows(ExportedBook,
+                    [{'book': book.id, 'checksum': checksums[book.id]}
+                     for book in books_to_export if book.id not in failures],
+                    upsert=True)
+
+    if failures:
+        logger.error("Export failed for {} book(s):".format(len(failures)))
+        for book_id, error in sorted(failures.items()):
+            logger.error("\t#{}: {}".format(book_id, error))
+    return failures
+
+
+def export_book_or_error(book, **kwargs):
+    """ export_book_to(book), returning its error message (None if fine)
+        instead of interrupting the whole export """
+    try:
+        export_book_to(book=book, **kwargs)
+    except Exception as e:
+        logger.error("\tUnable to export Book #{}: {}".format(book.id, e))
+        return "{}: {}".format(type(e).__name__, e)
+
+
+def init_export_worker(database, export_args, filters):
+    """ prepares a process exporting books for export_book_in_worker() """
+    use_database(database)
+    db.execute_sql('PRAGMA query_only = 1')
+
+    # logs are handed back to the parent process
+    collector = LogCollector()
+    logger.handlers = [collector]
+    logger.propagate = False
+
+    EXPORT_WORKER.update(export_args=export_args,
+                         books=get_list_of_filtered_books(**filters),
+                         collector=collector)
+
+
+def export_book_in_worker(book_id):
+    """ (book id, log records, error message) of exporting book_id """
+    collector = EXPORT_WORKER['collector']
+    try:
+        book = Book.get(id=book_id)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    else:
+        error = export_book_or_error(book=book, books=EXPORT_WORKER['books'],
+                                     **EXPORT_WORKER['export_args'])
+    return book_id, collector.pop_records(), error
+
+
+def export_files_for(book, companion_files, formats):
+    """ [(name in download cache, name in static folder)] of the files
+        export_book_to(book) exports """
+    files = [(fname_for(book, 'html'), article_name_for(book))]
+    files += [(fname, fname) for fname in companion_files.get(str(book.id), [])]
+    files += [(fname_for(book, format), archive_name_for(book, format))
+              for format in formats
+              if format in book.formats() and format != 'html']
+    return files
+
+
+def export_checksum(book, download_cache, companion_files, formats,
+                    html_engine, link_mode, templates_checksum):
+    """ md5 of what export_book_to(book) depends on: book's metadata,
+        export options, templates and size and modification time of
+        book's files in download_cache.
+
+        Cover pages, which show popularity and the rest of the collection,
+        are exported on every run and thus not covered.
+
+        Files are not hashed: that would mean reading all of them. """
+    files = []
+    for src, _ in export_files_for(book, companion_files, formats):
+        try:
+            stat = os.stat(os.path.join(download_cache, src))
+        except OSError:
+            files.append([src, None])
+        else:
+            files.append([src, stat.st_size, stat.st_mtime])
+
+    return hashlib.md5(json.dumps({
+        'book': [book.id, book.title, book.subtitle, book.language,
+                 book.author.gut_id, book.author.name(),
+                 book.license.slug, book.license.name,
+                 book.formats()],
+        'formats': formats,
+        'html_engine': html_engine,
+        'link_mode': link_mode,
+        'templates': templates_checksum,
+        'files': files,
+    }, sort_keys=True)).hexdigest()
+
+
+def is_exported(book, static_folder, download_cache, companion_files,
+                formats):
+    """ whether the files exported from book's files are in static_folder """
+    return all([path(os.path.join(static_folder, dst)).exists()
+                for src, dst in export_files_for(book, companion_files,
+                                                 formats)
+                if path(os.path.join(download_cache, src)).exists()])
 
 
 def article_name_for(book, cover=False):
@@ -186,7 +425,122 @@ def html_content_for(book, static_folder, download_cache):
         return f.read()
 
 
-def update_html_for_static(book, html_content, epub=False):
+# (start, end) markers of Project Gutenberg's boilerplate in books HTML
+BOILERPLATE_PATTERNS = [
+    ("*** START OF THE PROJECT GUTENBERG EBOOK",
+     "*** END OF THE PROJECT GUTENBERG EBOOK"),
+
+    ("***START OF THE PROJECT GUTENBERG EBOOK",
+     "***END OF THE PROJECT GUTENBERG EBOOK"),
+
+    ("<><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>",
+     "<><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>"),
+
+    # ePub only
+    ("*** START OF THIS PROJECT GUTENBERG EBOOK",
+     "*** START: FULL LICENSE ***"),
+    ("*END THE SMALL PRINT! FOR PUBLIC DOMAIN ETEXT",
+     "——————————————————————————-"),
+
+    ("*** START OF THIS PROJECT GUTENBERG EBOOK",
+     "*** END OF THIS PROJECT GUTENBERG EBOOK"),
+
+    ("***START OF THE PROJECT GUTENBERG",
+     "***END OF THE PROJECT GUTENBERG EBOOK"),
+
+    ("COPYRIGHT PROTECTED ETEXTS*END*",
+     "==========================================================="),
+
+    ("Nous remercions la Bibliothèque Nationale de France qui a mis à",
+     "The Project Gutenberg Etext of"),
+    ("Nous remercions la Bibliothèque Nationale de France qui a mis à",
+     "End of The Project Gutenberg EBook"),
+
+    ("=========================================================================",
+     "——————————————————————————-"),
+
+    ("Project Gutenberg Etext", "End of Project Gutenberg Etext"),
+
+    ("Text encoding is iso-8859-1", "Fin de Project Gutenberg Etext"),
+
+    ("—————————————————-", "Encode an ISO 8859/1 Etext into LaTeX or HTML"),
+]
+
+
+class MultiPatternScanner(object):
+
+    """ finds which of many strings occur in a text, in a single pass.
+
+        Patterns are tried longest first on each position, so a match also
+        reveals the patterns it contains. Search resumes right after the
+        start of each match to catch overlapping occurrences. """
+
+    def __init__(self, patterns):
+        self.patterns = sorted(set(patterns), key=len, reverse=True)
+        self.regexp = re.compile("|".join([re.escape(pattern)
+                                           for pattern in self.patterns]))
+        self.contained = dict([(pattern, set([other
+                                              for other in self.patterns
+                                              if other in pattern]))
+                               for pattern in self.patterns])
+
+    def found_in(self, text):
+        """ set of patterns present in text """
+        found = set()
+        match = self.regexp.search(text)
+        while match is not None and len(found) < len(self.patterns):
+            found |= self.contained[match.group()]
+            match = self.regexp.search(text, match.start() + 1)
+        return found
+
+
+BOILERPLATE_SCANNER = MultiPatternScanner(
+    [marker for markers in BOILERPLATE_PATTERNS for marker in markers])
+
+# as in BeautifulSoup's HTML tree builders
+WHITESPACE_PRESERVING_TAGS = ('pre', 'textarea')
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+HTML_DOCTYPE_RE = re.compile(r'\s*(<\?xml[^>]*>\s*)?<!DOCTYPE', re.I)
+
+
+def shortened_whitespace(text):
+    """ text as BeautifulSoup stores it: a newline or a space
+        if text is only made of whitespace """
+    if text and not text.strip(ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+# update all <a> links to internal HTML pages
+# should only apply to relative URLs to HTML files.
+# examples on #16816, #22889, #30021
+def replacablement_link(book, url):
+    try:
+        urlp, anchor = url.rsplit('#', 1)
+    except ValueError:
+        urlp = url
+        anchor = None
+    if '/' in urlp:
+        return None
+
+    if len(urlp.strip()):
+        nurl = "{id}_{url}".format(id=book.id, url=urlp)
+    else:
+        nurl = ""
+
+    if anchor is not None:
+        return "#".join([nurl, anchor])
+
+    return nurl
+
+
+def update_html_for_static(book, html_content, epub=False, engine='bs4'):
+    return HTML_UPDATERS[engine](book=book, html_content=html_content,
+                                 epub=epub)
+
+
+def update_html_for_static_bs4(book, html_content, epub=False):
 
     soup = BeautifulSoup(html_content, XML_PARSER)
 
@@ -197,28 +551,6 @@ def update_html_for_static(book, html_content, epub=False):
                 img.attrs['src'] = img.attrs['src'].replace(
                     'images/', '{id}_'.format(id=book.id))
 
-    # update all <a> links to internal HTML pages
-    # should only apply to relative URLs to HTML files.
-    # examples on #16816, #22889, #30021
-    def replacablement_link(book, url):
-        try:
-            urlp, anchor = url.rsplit('#', 1)
-        except ValueError:
-            urlp = url
-            anchor = None
-        if '/' in urlp:
-            return None
-
-        if len(urlp.strip()):
-            nurl = "{id}_{url}".format(id=book.id, url=urlp)
-        else:
-            nurl = ""
-
-        if anchor is not None:
-            return "#".join([nurl, anchor])
-
-        return nurl
-
     if not epub:
         for link in soup.findAll('a'):
             new_link = replacablement_link(
@@ -230,46 +562,6 @@ def update_html_for_static(book, html_content, epub=False):
     if not epub:
         soup.title.string = book.title
 
-    patterns = [
-        ("*** START OF THE PROJECT GUTENBERG EBOOK",
-         "*** END OF THE PROJECT GUTENBERG EBOOK"),
-
-        ("***START OF THE PROJECT GUTENBERG EBOOK",
-         "***END OF THE PROJECT GUTENBERG EBOOK"),
-
-        ("<><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>",
-         "<><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>"),
-
-        # ePub only
-        ("*** START OF THIS PROJECT GUTENBERG EBOOK",
-         "*** START: FULL LICENSE ***"),
-        ("*END THE SMALL PRINT! FOR PUBLIC DOMAIN ETEXT",
-         "——————————————————————————-"),
-
-        ("*** START OF THIS PROJECT GUTENBERG EBOOK",
-         "*** END OF THIS PROJECT GUTENBERG EBOOK"),
-
-        ("***START OF THE PROJECT GUTENBERG",
-         "***END OF THE PROJECT GUTENBERG EBOOK"),
-
-        ("COPYRIGHT PROTECTED ETEXTS*END*",
-         "==========================================================="),
-
-        ("Nous remercions la Bibliothèque Nationale de France qui a mis à",
-         "The Project Gutenberg Etext of"),
-        ("Nous remercions la Bibliothèque Nationale de France qui a mis à",
-         "End of The Project Gutenberg EBook"),
-
-        ("=========================================================================",
-         "——————————————————————————-"),
-
-        ("Project Gutenberg Etext", "End of Project Gutenberg Etext"),
-
-        ("Text encoding is iso-8859-1", "Fin de Project Gutenberg Etext"),
-
-        ("—————————————————-", "Encode an ISO 8859/1 Etext into LaTeX or HTML"),
-    ]
-
     body = soup.find('body')
     try:
         is_encapsulated_in_div = sum(
@@ -282,7 +574,7 @@ def update_html_for_static(book, html_content, epub=False):
         DEBUG_COUNT.append((book.id, book.title))
 
     if not is_encapsulated_in_div:
-        for start_of_text, end_of_text in patterns:
+        for start_of_text, end_of_text in BOILERPLATE_PATTERNS:
             if start_of_text not in body.text and end_of_text not in body.text:
                 continue
 
@@ -344,6 +636,172 @@ def update_html_for_static(book, html_content, epub=False):
     return soup.encode()
 
 
+def drop_keeping_tail(elem):
+    """ removes elem from its lxml tree but not the text following it """
+    parent = elem.getparent()
+    if elem.tail:
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + elem.tail
+        else:
+            parent.text = (parent.text or "") + elem.tail
+    parent.remove(elem)
+
+
+def update_html_for_static_lxml(book, html_content, epub=False):
+    """ update_html_for_static_bs4() on an lxml tree: links and images are
+        rewritten in a single traversal and boilerplate markers are all
+        looked for in a single scan of the body's text """
+
+    # same encoding detection as BeautifulSoup
+    encoding = UnicodeDammit(html_content, is_html=True).original_encoding
+    # plain lxml.etree elements: lxml.html ones are slower to iterate over
+    root = lxml.etree.fromstring(
+        html_content, lxml.etree.HTMLParser(encoding=encoding))
+    if root is None:
+        raise ValueError("Empty HTML for #{}".format(book.id))
+
+    # nodes whose whitespace BeautifulSoup keeps as is
+    preserved = set()
+    for elem in root.iter(*WHITESPACE_PRESERVING_TAGS):
+        preserved.update(elem.iter())
+
+    for elem in root.iter():
+        # BeautifulSoup shortens whitespace-only strings
+        if elem not in preserved:
+            elem.text = shortened_whitespace(elem.text)
+        if elem.getparent() not in preserved:
+            elem.tail = shortened_whitespace(elem.tail)
+
+        if epub:
+            continue
+
+        if elem.tag == 'img':
+            # update <img> links from images/xxx.xxx to {id}_xxx.xxx
+            if 'src' in elem.attrib:
+                elem.set('src', elem.get('src').replace(
+                    'images/', '{id}_'.format(id=book.id)))
+        elif elem.tag == 'a':
+            new_link = replacablement_link(
+                book=book, url=elem.get('href', ''))
+            if new_link is not None:
+                elem.set('href', new_link)
+
+    # Add the title
+    if not epub:
+        title = root.find('.//title')
+        if title is None:
+            raise AttributeError("No <title> in HTML of #{}".format(book.id))
+        for child in title:
+            title.remove(child)
+        title.text = book.title
+
+    body = root.find('.//body')
+    if body is None:
+        raise AttributeError("No <body> in HTML of #{}".format(book.id))
+
+    def is_tag(node):
+        # comments and processing instructions are strings for bs4
+        return isinstance(node.tag, basestring)
+
+    def text_of(node):
+        return "".join(node.itertext()) if is_tag(node) else ""
+
+    is_encapsulated_in_div = sum([1 for e in body if is_tag(e)]) == 1
+
+    if is_encapsulated_in_div and not epub:
+        DEBUG_COUNT.append((book.id, book.title))
+
+    if not is_encapsulated_in_div:
+        found = BOILERPLATE_SCANNER.found_in(text_of(body))
+
+        # body's children as bs4 lists them: strings are None.
+        # Walked like bs4 does: removing a child skips the next one.
+        contents = [None] if body.text else []
+        for child in body:
+            contents.append(child if is_tag(child) else None)
+            if child.tail:
+                contents.append(None)
+
+        def walk(on_child):
+            index = 0
+            while index < len(contents):
+                child = contents[index]
+                index += 1
+                if child is not None and on_child(child):
+                    drop_keeping_tail(child)
+                    del contents[index - 1]
+
+        for start_of_text, end_of_text in BOILERPLATE_PATTERNS:
+            has_start = start_of_text in found
+            has_end = end_of_text in found
+            if not has_start and not has_end:
+                continue
+
+            # whether children are removed: until start, from end on
+            state = {'remove': has_start}
+
+            def on_child(child):
+                text = text_of(child)
+                if has_end and end_of_text in text:
+                    state['remove'] = True
+                if has_start and start_of_text in text:
+                    state['remove'] = False
+                    return True
+                return state['remove']
+
+            walk(on_child)
+            break
+
+    # build infobox
+    if not epub:
+        infobox = jinja_env.get_template('book_infobox.html')
+        infobox_html = infobox.render({'book': book})
+        info_div = lxml.etree.fromstring(infobox_html,
+                                         lxml.etree.HTMLParser()) \
+                             .find('.//div')
+        for elem in info_div.iter():
+            elem.text = shortened_whitespace(elem.text)
+            elem.tail = shortened_whitespace(elem.tail)
+        info_div.tail = body.text
+        body.text = None
+        body.insert(0, info_div)
+
+    # BeautifulSoup declares the encoding it outputs
+    for meta in root.iter('meta'):
+        if 'charset' in meta.attrib:
+            meta.set('charset', 'utf-8')
+        elif meta.get('http-equiv', '').lower() == 'content-type' \
+                and 'content' in meta.attrib:
+            meta.set('content', re.sub(r'((^|;)\s*charset=)([^;]*)',
+                                       r'\1utf-8', meta.get('content')))
+
+    # libxml2 adds a default DOCTYPE to documents without one and, for
+    # XHTML ones, serializes with extra attributes (xmlns, id on <a name>)
+    docinfo = root.getroottree().docinfo
+    doctype = docinfo.doctype
+    docinfo.clear()
+    html = lxml.etree.tostring(root, encoding='utf-8',
+                               method='xml' if epub else 'html')
+    if HTML_DOCTYPE_RE.match(html_content):
+        html = doctype.encode('utf-8') + b'\n' + html
+
+    # if there is no charset, set it to utf8
+    if not epub:
+        utf = '<meta http-equiv="Content-Type" content="text/html;' \
+              ' charset=UTF-8" />'
+        utf = '<head>{}'.format(utf)
+
+        return html.replace(str('<head>'), str(utf))
+
+    return html
+
+
+HTML_UPDATERS = {'bs4': update_html_for_static_bs4}
+if lxml is not None:
+    HTML_UPDATERS['lxml'] = update_html_for_static_lxml
+
+
 def cover_html_content_for(book, static_folder, books):
     cover_img = "{id}_cover.jpg".format(id=book.id)
     cover_img = cover_img \
@@ -358,7 +816,7 @@ def cover_html_content_for(book, static_folder, books):
     context.update({
         'book': book,
         'cover_img': cover_img,
-        'formats': main_formats_for(book),
+        'formats': book.formats(),
         'translate_author': translate_author,
         'translate_license': translate_license
     })
@@ -366,11 +824,21 @@ def cover_html_content_for(book, static_folder, books):
     return template.render(**context)
 
 
+class ExportError(Exception):
+
+    """ some files of a book could not be exported """
+
+
 def export_book_to(book,
                    static_folder, download_cache,
-                   cached_files, languages, formats, books):
+                   companion_files, languages, formats, books,
+                   html_engine='bs4', link_mode='copy', image_threads=None):
     logger.info("\tExporting Book #{id}.".format(id=book.id))
 
+    # errors on files which don't stop the export of the others, but have
+    # the book fail (and be exported again on next incremental export)
+    errors = []
+
     # actual book content, as HTML
     html = html_content_for(book=book,
                             static_folder=static_folder,
@@ -379,133 +847,103 @@ def export_book_to(book,
         article_fpath = os.path.join(static_folder, article_name_for(book))
         logger.info("\t\tExporting to {}".format(article_fpath))
         try:
-            new_html = update_html_for_static(book=book, html_content=html)
+            new_html = update_html_for_static(book=book, html_content=html,
+                                              engine=html_engine)
         except:
             new_html = html
         with open(article_fpath, 'w') as f:
             f.write(new_html)
 
-    def symlink_from_cache(fname, dstfname=None):
-        src = os.path.join(path(download_cache).abspath(), fname)
-        if dstfname is None:
-            dstfname = fname
-        dst = os.path.join(path(static_folder).abspath(), dstfname)
-        logger.info("\t\tSymlinking {}".format(dst))
-        path(dst).unlink_p()
-        try:
-            path(src).link(dst)  # hard link
-        except IOError:
-            logger.error("/!\ Unable to symlink missing file {}".format(src))
-            return
-
-    def copy_from_cache(fname, dstfname=None):
+    def copy_from_cache(fname, dstfname=None, link_mode='copy'):
         src = os.path.join(path(download_cache).abspath(), fname)
         if dstfname is None:
             dstfname = fname
         dst = os.path.join(path(static_folder).abspath(), dstfname)
         logger.info("\t\tCopying {}".format(dst))
+        # never write through a link to the download cache
         path(dst).unlink_p()
         try:
-            path(src).copy(dst)
-        except IOError:
-            logger.error("/!\ Unable to copy missing file {}".format(src))
-            return
-
-    def optimize_image(fpath):
-        if path(fpath).ext == '.png':
-            return optimize_png(fpath)
-        if path(fpath).ext in ('.jpg', '.jpeg'):
-            return optimize_jpeg(fpath)
-        if path(fpath).ext == '.gif':
-            return optimize_gif(fpath)
-        return fpath
-
-    def optimize_gif(fpath):
-        exec_cmd('gifsicle -O3 "{path}" -o "{path}"'.format(path=fpath))
-
-    def optimize_png(fpath):
-        pngquant = 'pngquant --nofs --force --ext=".png" "{path}"'
-        advdef = 'advdef -z -4 -i 5 "{path}"'
-        exec_cmd(pngquant.format(path=fpath))
-        exec_cmd(advdef.format(path=fpath))
-
-    def optimize_jpeg(fpath):
-        exec_cmd('jpegoptim --strip-all -m50 "{path}"'.format(path=fpath))
+            link_or_copy(src, dst, mode=link_mode)
+        except (IOError, OSError) as e:
+            logger.error("/!\ Unable to copy {}: {}".format(src, e))
+            raise
 
     def optimize_epub(src, dst):
         logger.info("\t\tCreating ePUB at {}".format(dst))
-        zipped_files = []
-        # create temp directory to extract to
-        tmpd = tempfile.mkdtemp(dir=TMP_FOLDER)
-        with zipfile.ZipFile(src, 'r') as zf:
-            zipped_files = zf.namelist()
-            zf.extractall(tmpd)
-
-        remove_cover = False
-        for fname in zipped_files:
-            fnp = os.path.join(tmpd, fname)
-            if path(fname).ext in ('.png', '.jpeg', '.jpg', '.gif'):
-
-                # special case to remove ugly cover
-                if fname.endswith('cover.jpg') and is_bad_cover(fnp):
-                    zipped_files.remove(fname)
-                    remove_cover = True
-                else:
-                    optimize_image(path_for_cmd(fnp))
-
-            if path(fname).ext in ('.htm', '.html'):
-                f = open(fnp, 'r')
-                html = update_html_for_static(book=book,
-                                              html_content=f.read(),
-                                              epub=True)
-                f.close()
-                with open(fnp, 'w') as f:
-                    f.write(html)
-
-            if path(fname).ext == '.ncx':
-                pattern = "*** START: FULL LICENSE ***"
-                f = open(fnp, 'r')
-                ncx = f.read()
-                f.close()
-                soup = BeautifulSoup(ncx, ["lxml", "xml"])
-                for tag in soup.findAll('text'):
-                    if pattern in tag.text:
-                        s = tag.parent.parent
+        with zipfile.ZipFile(src, 'r') as zin:
+            # folders are not stored
+            infos = [info for info in zin.infolist()
+                     if not info.filename.endswith('/')]
+
+            # images are optimized together, before the OPF is rewritten
+            remove_cover = False
+            images = {}
+            for info in infos:
+                if path(info.filename).ext in ('.png', '.jpeg', '.jpg',
+                                               '.gif'):
+                    data = zin.read(info)
+
+                    # special case to remove ugly cover
+                    if info.filename.endswith('cover.jpg') \
+                            and is_bad_cover(data):
+                        remove_cover = True
+                    else:
+                        images[info.filename] = data
+            images, optimized = optimized_images_data(
+                images, nb_threads=image_threads)
+            if not optimized:
+                errors.append("images of {} not optimized"
+                              .format(path(src).basename()))
+
+            # mimetype must be the first file, uncompressed
+            infos.sort(key=lambda info: info.filename != 'mimetype')
+            with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zout:
+                for info in infos:
+                    fname = info.filename
+                    if path(fname).ext in ('.png', '.jpeg', '.jpg', '.gif'):
+                        if fname not in images:
+                            continue
+                        data = images[fname]
+                    else:
+                        data = repacked_epub_file(zin.read(info), fname,
+                                                  remove_cover=remove_cover)
+
+                    # keeps dates and permissions of the original
+                    out_info = zipfile.ZipInfo(fname, info.date_time)
+                    out_info.external_attr = info.external_attr
+                    out_info.compress_type = zipfile.ZIP_STORED \
+                        if fname == 'mimetype' else zipfile.ZIP_DEFLATED
+                    zout.writestr(out_info, data)
+
+    def repacked_epub_file(data, fname, remove_cover):
+        """ data of EPUB's file fname, updated for export """
+        if path(fname).ext in ('.htm', '.html'):
+            return update_html_for_static(book=book, html_content=data,
+                                          epub=True, engine=html_engine)
+
+        if path(fname).ext == '.ncx':
+            pattern = "*** START: FULL LICENSE ***"
+            soup = BeautifulSoup(data, ["lxml", "xml"])
+            for tag in soup.findAll('text'):
+                if pattern in tag.text:
+                    s = tag.parent.parent
+                    s.decompose()
+                    for s in s.next_siblings:
                         s.decompose()
-                        for s in s.next_siblings:
-                            s.decompose()
-                        s.next_sibling
-
-                with open(fnp, 'w') as f:
-                    f.write(soup.encode())
+                    s.next_sibling
+            return soup.encode()
 
-        # delete {id}/cover.jpg if exist and update {id}/content.opf
-        if remove_cover:
+        # {id}/cover.jpg is removed: update {id}/content.opf
+        if remove_cover and fname == "{}/content.opf".format(book.id):
+            soup = BeautifulSoup(data, ["lxml", "xml"])
+            for elem in soup.findAll():
+                if getattr(elem, 'attrs', {}).get('href') == 'cover.jpg':
+                    elem.decompose()
+            return soup.encode()
 
-            # remove cover
-            path(os.path.join(tmpd, str(book.id), 'cover.jpg')).unlink_p()
+        return data
 
-            soup = None
-            opff = os.path.join(tmpd, str(book.id), 'content.opf')
-            if os.path.exists(opff):
-                with open(opff, 'r') as fd:
-                    soup = BeautifulSoup(fd.read(), ["lxml", "xml"])
-
-                for elem in soup.findAll():
-                    if getattr(elem, 'attrs', {}).get('href') == 'cover.jpg':
-                        elem.decompose()
-
-                with(open(opff, 'w')) as fd:
-                    fd.write(soup.encode())
-
-        with cd(tmpd):
-            exec_cmd('zip -q0X "{dst}" mimetype'.format(dst=path_for_cmd(dst)))
-            exec_cmd('zip -qXr9D "{dst}" {files}'
-                     .format(dst=path_for_cmd(dst),
-                             files=" ".join([f for f in zipped_files
-                                             if not f == 'mimetype'])))
-
-        path(tmpd).rmtree_p()
+    companion_images = []
 
     def handle_companion_file(fname, dstfname=None, book=None):
         src = os.path.join(path(download_cache).abspath(), fname)
@@ -513,27 +951,36 @@ def export_book_to(book,
             dstfname = fname
         dst = os.path.join(path(static_folder).abspath(), dstfname)
 
+        # not downloaded (not on mirror): not an export failure
+        if not path(src).exists():
+            logger.warning("/!\ Unable to copy missing file {}".format(src))
+            return
+
         # optimization based on mime/extension
         if path(fname).ext in ('.png', '.jpg', '.jpeg', '.gif'):
+            # always a copy: images are optimized in place,
+            # with the other images of the book, at once
             copy_from_cache(src, dst)
-            optimize_image(path_for_cmd(dst))
+            companion_images.append(dst)
         elif path(fname).ext == '.epub':
-            tmp_epub = tempfile.NamedTemporaryFile(suffix='.epub',
-                                                   dir=TMP_FOLDER)
-            tmp_epub.close()
-            optimize_epub(src, tmp_epub.name)
-            path(tmp_epub.name).move(dst)
+            # never leaves a half-written EPUB at dst
+            partial_dst = "{}.part".format(dst)
+            try:
+                optimize_epub(src, partial_dst)
+            except:
+                path(partial_dst).unlink_p()
+                raise
+            path(partial_dst).move(dst)
         else:
             # excludes files created by Windows Explorer
             if src.endswith('_Thumbs.db'):
                 return
-            # copy otherwise (PDF mostly)
+            # copy otherwise (PDF mostly), unmodified: may be a link
             logger.debug("\t\tshitty ext: {}".format(dst))
-            copy_from_cache(src, dst)
+            copy_from_cache(src, dst, link_mode=link_mode)
 
     # associated files (images, etc)
-    for fname in [fn for fn in cached_files
-                  if fn.startswith("{}_".format(book.id))]:
+    for fname in companion_files.get(str(book.id), []):
 
         if path(fname).ext in ('.html', '.htm'):
             src = os.path.join(path(download_cache).abspath(), fname)
@@ -543,7 +990,8 @@ def export_book_to(book,
             html = "CAN'T READ FILE"
             with open(src, 'r') as f:
                 html = f.read()
-            new_html = update_html_for_static(book=book, html_content=html)
+            new_html = update_html_for_static(book=book, html_content=html,
+                                              engine=html_engine)
             with open(dst, 'w') as f:
                 f.write(new_html)
         else:
@@ -553,6 +1001,15 @@ def export_book_to(book,
             except Exception as e:
                 logger.error("\t\tException while handling companion file: {}"
                              .format(e))
+                errors.append("{}: {}".format(fname, e))
+
+    logger.info("\t\tOptimizing {} images".format(len(companion_images)))
+    try:
+        if not optimize_images(companion_images, nb_threads=image_threads):
+            errors.append("images not optimized")
+    except Exception as e:
+        logger.error("\t\tException while optimizing images: {}".format(e))
+        errors.append("images not optimized: {}".format(e))
 
     # other formats
     for format in formats:
@@ -566,8 +1023,16 @@ def export_book_to(book,
         except Exception as e:
             logger.error("\t\tException while handling companion file: {}"
                          .format(e))
+            errors.append("{}: {}".format(format, e))
 
     # book presentation article
+    export_cover_to(book=book, static_folder=static_folder, books=books)
+
+    if errors:
+        raise ExportError("; ".join(errors))
+
+
+def export_cover_to(book, static_folder, books):
     cover_fpath = os.path.join(static_folder,
                                article_name_for(book=book, cover=True))
     logger.info("\t\tExporting to {}".format(cover_fpath))
@@ -579,19 +1044,19 @@ def export_book_to(book,
 
 
 def authors_from_ids(idlist):
-    ''' build a list of Author objects based on a list of author.gut_id
+    ''' build a list of Author objects based on a list of author.gut_id,
+        sorted by name
 
-        Used to overcome large SELECT IN SQL stmts which peewee complains
-        about. Slower !! '''
+        Fetched in chunks of IDs small enough for SQLite's IN clause
+        then sorted in memory, as the DB would on (last_name, first_names) '''
+    idlist = list(set(idlist))
     authors = []
-    for author in Author.select().order_by(Author.last_name.asc(),
-                                           Author.first_names.asc()):
-        if author.gut_id not in idlist:
-            continue
-        if author in authors:
-            continue
-        authors.append(author)
-    return authors
+    for start in range(0, len(idlist), SQLITE_MAX_VARIABLES):
+        authors += list(Author.select().where(
+            Author.gut_id << idlist[start:start + SQLITE_MAX_VARIABLES]))
+    return sorted(authors, key=lambda author: (author.last_name,
+                                               author.first_names,
+                                               author.gut_id))
 
 
 def export_to_json_helpers(books, static_folder, languages, formats):
@@ -603,44 +1068,59 @@ def export_to_json_helpers(books, static_folder, languages, formats):
             f.write(";")
             # json.dump(col, f)
 
+    # single scan of the filtered catalog, authors included
+    catalog = list(books.switch(Book).join(Author).select(Book, Author))
+    by_popularity = sorted(catalog,
+                           key=lambda book: (-book.downloads, book.id))
+    by_title = sorted(catalog, key=lambda book: (book.title, book.id))
+    arrays = dict([(book.id, book.to_array()) for book in catalog])
+
+    def grouped(sorted_books, key):
+        """ {key(book): [book.to_array()]} keeping sorted_books order """
+        groups = {}
+        for book in sorted_books:
+            groups.setdefault(key(book), []).append(arrays[book.id])
+        return groups
+
     # all books sorted by popularity
     logger.info("\t\tDumping full_by_popularity.js")
-    dumpjs([book.to_array()
-            for book in books.order_by(Book.downloads.desc())],
+    dumpjs([arrays[book.id] for book in by_popularity],
            'full_by_popularity.js')
 
     # all books sorted by title
     logger.info("\t\tDumping full_by_title.js")
-    dumpjs([book.to_array()
-            for book in books.order_by(Book.title.asc())],
+    dumpjs([arrays[book.id] for book in by_title],
            'full_by_title.js')
 
-    avail_langs = get_langs_with_count(books=books)
+    avail_langs = get_langs_with_count(books=catalog)
+
+    def language_of(book):
+        return book.language
 
-    all_filtered_authors = []
+    def author_of(book):
+        return book.author.gut_id
+
+    all_filtered_authors = set()
 
     # language-specific collections
+    lang_by_popularity = grouped(by_popularity, language_of)
+    lang_by_title = grouped(by_title, language_of)
+    lang_authors = {}
+    for book in catalog:
+        lang_authors.setdefault(book.language, set()).add(author_of(book))
+
     for lang_name, lang, lang_count in avail_langs:
-        lang_filtered_authors = list(
-            set([book.author.gut_id for book in books.filter(language=lang)]))
-        for aid in lang_filtered_authors:
-            if aid not in all_filtered_authors:
-                all_filtered_authors.append(aid)
+        lang_filtered_authors = lang_authors[lang]
+        all_filtered_authors |= lang_filtered_authors
 
         # by popularity
         logger.info("\t\tDumping lang_{}_by_popularity.js".format(lang))
-        dumpjs(
-            [book.to_array()
-             for book in books.where(Book.language == lang)
-                              .order_by(Book.downloads.desc())],
-            'lang_{}_by_popularity.js'.format(lang))
+        dumpjs(lang_by_popularity[lang],
+               'lang_{}_by_popularity.js'.format(lang))
         # by title
         logger.info("\t\tDumping lang_{}_by_title.js".format(lang))
-        dumpjs(
-            [book.to_array()
-             for book in books.where(Book.language == lang)
-                              .order_by(Book.title.asc())],
-            'lang_{}_by_title.js'.format(lang))
+        dumpjs(lang_by_title[lang],
+               'lang_{}_by_title.js'.format(lang))
 
         authors = authors_from_ids(lang_filtered_authors)
         logger.info("\t\tDumping authors_lang_{}.js".format(lang))
@@ -648,25 +1128,20 @@ def export_to_json_helpers(books, static_folder, languages, formats):
                'authors_lang_{}.js'.format(lang), 'authors_json_data')
 
     # author specific collections
+    auth_by_popularity = grouped(by_popularity, author_of)
+    auth_by_title = grouped(by_title, author_of)
     authors = authors_from_ids(all_filtered_authors)
     for author in authors:
 
-        # all_filtered_authors.remove(author.gut_id)
         # by popularity
         logger.info(
             "\t\tDumping auth_{}_by_popularity.js".format(author.gut_id))
-        dumpjs(
-            [book.to_array()
-             for book in books.where(Book.author == author)
-                              .order_by(Book.downloads.desc())],
-            'auth_{}_by_popularity.js'.format(author.gut_id))
+        dumpjs(auth_by_popularity[author.gut_id],
+               'auth_{}_by_popularity.js'.format(author.gut_id))
         # by title
         logger.info("\t\tDumping auth_{}_by_title.js".format(author.gut_id))
-        dumpjs(
-            [book.to_array()
-             for book in books.where(Book.author == author)
-                              .order_by(Book.title.asc())],
-            'auth_{}_by_title.js'.format(author.gut_id))
+        dumpjs(auth_by_title[author.gut_id],
+               'auth_{}_by_title.js'.format(author.gut_id))
 
     # authors list sorted by name
     logger.info("\t\tDumping authors.js")
@@ -678,7 +1153,7 @@ def export_to_json_helpers(books, static_folder, languages, formats):
     dumpjs(avail_langs, 'languages.js', 'languages_json_data')
 
     # languages by weight
-    main_languages, other_languages = get_lang_groups(books)
+    main_languages, other_languages = get_lang_groups(catalog)
     logger.info("\t\tDumping main_languages.js")
     dumpjs(main_languages, 'main_languages.js', 'main_languages_json_data')
     dumpjs(other_languages, 'other_languages.js', 'other_languages_json_data')
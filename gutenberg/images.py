@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import os
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
+
+import envoy
+from path import path
+
+from gutenberg import logger
+from gutenberg.utils import md5sum
+
+# optimized images, named after the MD5 of the image they were optimized
+# from: an image is never optimized twice, whichever book it comes from.
+OPTIMIZED_IMAGES_FOLDER = 'optimized-images'
+
+# max number of images handed to a single run of a tool
+IMAGES_BATCH_SIZE = 32
+
+# commands optimizing in place the images which paths are appended to them
+OPTIMIZE_COMMANDS = {
+    '.png': [['pngquant', '--nofs', '--force', '--ext=.png'],
+             ['advdef', '-z', '-4', '-i', '5']],
+    '.jpg': [['jpegoptim', '--strip-all', '-m50']],
+    '.jpeg': [['jpegoptim', '--strip-all', '-m50']],
+    '.gif': [['gifsicle', '--batch', '-O3']],
+}
+
+# {tool: whether it is installed}, looked up once
+AVAILABLE_TOOLS = {}
+
+
+def is_tool_available(tool):
+    if tool not in AVAILABLE_TOOLS:
+        AVAILABLE_TOOLS[tool] = find_executable(tool) is not None
+        if not AVAILABLE_TOOLS[tool]:
+            logger.warning("\t\t{} is not installed: images using it are "
+                           "not optimized".format(tool))
+    return AVAILABLE_TOOLS[tool]
+
+
+def check_tools():
+    """ looks up every tool once, warning about those not installed.
+
+        Processes forked afterwards know them and do not warn again """
+    for commands in OPTIMIZE_COMMANDS.values():
+        for command in commands:
+            is_tool_available(command[0])
+
+
+def missing_tools_for(ext):
+    """ [tool] of OPTIMIZE_COMMANDS[ext] not installed """
+    return [command[0] for command in OPTIMIZE_COMMANDS[ext]
+            if not is_tool_available(command[0])]
+
+
+def is_optimizable(fpath):
+    return path(fpath).ext in OPTIMIZE_COMMANDS
+
+
+def optimize_batch(fpaths):
+    """ runs the tools optimizing fpaths (images of the same type) in place.
+
+        Returns whether all tools succeeded """
+    # arguments are not parsed by a shell: paths need no quoting
+    fpaths = [fpath.encode('utf-8') if isinstance(fpath, unicode) else fpath
+              for fpath in fpaths]
+    for command in OPTIMIZE_COMMANDS[path(fpaths[0]).ext]:
+        try:
+            result = envoy.run([command + fpaths])
+        except Exception as e:
+            logger.error("\t\tUnable to run {} on {} images: {}"
+                         .format(command[0], len(fpaths), e))
+            return False
+        if result.status_code != 0:
+            logger.error("\t\t{} failed on {} images ({}): {}"
+                         .format(command[0], len(fpaths),
+                                 result.status_code, result.std_err.strip()))
+            return False
+    return True
+
+
+def cached_fpath_for(cache_folder, checksum, ext):
+    return os.path.join(cache_folder, "{}{}".format(checksum, ext))
+
+
+def store_in_cache(fpath, cached_fpath):
+    """ copies fpath to cached_fpath, which is never seen half-written
+        by other processes sharing the cache """
+    fd, tmp_fpath = tempfile.mkstemp(dir=path(cached_fpath).parent)
+    os.close(fd)
+    path(fpath).copyfile(tmp_fpath)
+    path(tmp_fpath).rename(cached_fpath)
+
+
+def optimize_images(fpaths, cache_folder=OPTIMIZED_IMAGES_FOLDER,
+                    nb_threads=None):
+    """ optimizes the images at fpaths in place.
+
+        Images which content was already optimized are copied from
+        cache_folder. Others are optimized by batches of images of the
+        same type, nb_threads (one per CPU by default) batches at a time,
+        and then cached. Images which tools are missing or failed are
+        left as is, and not cached.
+
+        Returns whether no tool failed: a missing tool is a setup issue,
+        reported once by is_tool_available() """
+    path(cache_folder).makedirs_p()
+
+    # {(MD5, extension): [paths of images with that content]}
+    images = {}
+    for fpath in fpaths:
+        if is_optimizable(fpath) and path(fpath).exists():
+            images.setdefault((md5sum(fpath), path(fpath).ext), []) \
+                  .append(fpath)
+
+    # {extension: [(MD5, path)]} of images to optimize
+    to_optimize = {}
+    success = True
+    for (checksum, ext), same_fpaths in images.items():
+        cached_fpath = cached_fpath_for(cache_folder, checksum, ext)
+        if path(cached_fpath).exists():
+            for fpath in same_fpaths:
+                path(cached_fpath).copyfile(fpath)
+        elif missing_tools_for(ext):
+            continue
+        else:
+            to_optimize.setdefault(ext, []).append((checksum,
+                                                    same_fpaths[0]))
+    if not to_optimize:
+        return success
+
+    # small enough batches for all threads to be busy
+    nb_threads = nb_threads or multiprocessing.cpu_count()
+    nb_images = sum([len(ext_images) for ext_images in to_optimize.values()])
+    batch_size = max(1, min(IMAGES_BATCH_SIZE, -(-nb_images // nb_threads)))
+    batches = [ext_images[start:start + batch_size]
+               for ext_images in to_optimize.values()
+               for start in range(0, len(ext_images), batch_size)]
+
+    pool = ThreadPool(min(nb_threads, len(batches)))
+    try:
+        results = pool.map(
+            optimize_batch,
+            [[fpath for _, fpath in batch] for batch in batches])
+    finally:
+        pool.close()
+        pool.join()
+
+    for batch, batch_success in zip(batches, results):
+        if not batch_success:
+            success = False
+            continue
+        for checksum, fpath in batch:
+            ext = path(fpath).ext
+            store_in_cache(fpath,
+                           cached_fpath_for(cache_folder, checksum, ext))
+            for same_fpath in images[(checksum, ext)][1:]:
+                path(fpath).copyfile(same_fpath)
+    return success
+
+
+def optimized_images_data(images, cache_folder=OPTIMIZED_IMAGES_FOLDER,
+                          nb_threads=None):
+    """ ({name: optimized content}, whether no tool failed) of images
+        ({name: content}), as optimize_images() would optimize them as
+        files.
+
+        Only images missing from the cache are written to (temporary)
+        files, which the tools need. """
+    optimized = {}
+    missing = {}
+    for name, data in images.items():
+        cached_fpath = cached_fpath_for(
+            cache_folder, hashlib.md5(data).hexdigest(), path(name).ext)
+        if not is_optimizable(name):
+            optimized[name] = data
+        elif path(cached_fpath).exists():
+            optimized[name] = path(cached_fpath).bytes()
+        else:
+            missing[name] = data
+    if not missing:
+        return optimized, True
+
+    path(cache_folder).makedirs_p()
+    tmpd = tempfile.mkdtemp(dir=cache_folder)
+    try:
+        # {name: temporary path}
+        fpaths = {}
+        for index, (name, data) in enumerate(missing.items()):
+            fpaths[name] = os.path.join(
+                tmpd, "{}{}".format(index, path(name).ext))
+            path(fpaths[name]).write_bytes(data)
+
+        success = optimize_images(fpaths.values(), cache_folder=cache_folder,
+                                  nb_threads=nb_threads)
+        for name, fpath in fpaths.items():
+            optimized[name] = path(fpath).bytes()
+    finally:
+        path(tmpd).rmtree_p()
+    return optimized, success
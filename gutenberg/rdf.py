@@ -6,32 +6,59 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import os
 import re
+import time
+import hashlib
+import tarfile
+import functools
+import itertools
+import multiprocessing
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 from path import path
 from bs4 import BeautifulSoup
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
 from gutenberg import logger, XML_PARSER
-from gutenberg.utils import exec_cmd, download_file
-from gutenberg.database import (Author, Format, BookFormat, License, Book)
-from gutenberg.utils import BAD_BOOKS_FORMATS, FORMAT_MATRIX
+from gutenberg.utils import (exec_cmd, download_file, http_session,
+                             TeeReader, HTTP_TIMEOUT)
+from gutenberg.database import (db, Author, Format, BookFormat, License, Book,
+                                RdfFile, ParseFilters, insert_rows)
+from gutenberg.utils import (BAD_BOOKS_FORMATS, FORMAT_MATRIX,
+                             formats_mask_for)
+
+
+RDF_TARBALL = 'rdf-files.tar.bz2'
+
+# number of books written to DB per transaction
+PARSE_BATCH_SIZE = 500
+
+# --books lookups: number of IDs from which RDF files are read by threads
+PARALLEL_LOOKUP_MIN = 64
+LOOKUP_THREADS = 16
 
 
-def setup_rdf_folder(rdf_url, rdf_path):
+def setup_rdf_folder(rdf_url, rdf_path, extract=True, timeout=HTTP_TIMEOUT):
     """ Download and Extract rdf-files """
 
-    rdf_tarball = download_rdf_file(rdf_url)
-    extract_rdf_files(rdf_tarball, rdf_path)
+    rdf_tarball = download_rdf_file(rdf_url, timeout=timeout)
+    if extract:
+        extract_rdf_files(rdf_tarball, rdf_path)
 
 
-def download_rdf_file(rdf_url):
-    fname = 'rdf-files.tar.bz2'
+def download_rdf_file(rdf_url, timeout=HTTP_TIMEOUT):
+    fname = RDF_TARBALL
 
     if path(fname).exists():
         logger.info("\tdf-files.tar.bz2 already exists in {}".format(fname))
         return fname
 
     logger.info("\tDownloading {} into {}".format(rdf_url, fname))
-    download_file(rdf_url, fname)
+    download_file(rdf_url, fname, timeout=timeout)
 
     return fname
 
@@ -53,45 +80,338 @@ def extract_rdf_files(rdf_tarball, rdf_path):
     return
 
 
-def parse_and_fill(rdf_path, only_books=[]):
+def parse_and_fill(rdf_path, only_books=[], nb_workers=1, engine='bs4',
+                   incremental=False, snapshot=None,
+                   languages=[], formats=[], timeout=HTTP_TIMEOUT):
+    """ parse RDF files from rdf_path and save them in DB
+
+        rdf_path is either an extracted folder, the rdf-files.tar.bz2
+        tarball itself, which is then read as a stream (no extraction)
+        or the tarball's URL: download, decompression, parsing and
+        saving then all happen as a single pipelined stream.
+
+        incremental only parses RDF files which changed since they were
+        last parsed and removes books which are not in the catalog anymore.
+
+        snapshot is the path of a catalog snapshot to write parsed
+        files to (see gutenberg.snapshot). It holds unfiltered files.
+
+        languages and formats filter books (and their formats) before
+        they are saved in DB. See save_rdf_in_database().
+
+        timeout is that of the connection to rdf_path, if a URL """
     logger.info("\tLooping throught RDF files in {}".format(rdf_path))
 
+    if '://' in rdf_path:
+        rdf_entries = rdf_entries_from_url(rdf_path, only_books=only_books,
+                                           timeout=timeout)
+    elif path(rdf_path).isfile():
+        rdf_entries = rdf_entries_in_tarball(rdf_path, only_books=only_books)
+    else:
+        rdf_entries = rdf_entries_in_folder(rdf_path, only_books=only_books)
+    parse_entry = functools.partial(parse_rdf_entry, engine=engine)
+
+    if incremental:
+        checksums = dict(RdfFile.select(RdfFile.gid, RdfFile.checksum)
+                                .tuples())
+        # books of a DB predating RdfFile have no checksum
+        known_ids = set(checksums.keys()) | \
+            set([book_id for book_id, in Book.select(Book.id).tuples()])
+        if needs_full_parse(languages=languages, formats=formats):
+            logger.info("\tFilters changed since last parse (or unknown): "
+                        "parsing all RDF files")
+            checksums = {}
+        catalog_ids = set()
+        rdf_entries = changed_rdf_entries(rdf_entries, checksums=checksums,
+                                          catalog_ids=catalog_ids)
+
+    def save(parsers):
+        if snapshot is None:
+            return process_parsed_rdfs(parsers, languages=languages,
+                                       formats=formats)
+
+        from gutenberg.snapshot import SnapshotWriter
+        if incremental or len(only_books):
+            logger.warning("\tSnapshot {} will only hold the RDF files "
+                           "parsed during this run".format(snapshot))
+        with SnapshotWriter(snapshot) as writer:
+            return process_parsed_rdfs(writer.tee(parsers),
+                                       languages=languages, formats=formats)
+
+    start = time.time()
+    if nb_workers > 1:
+        # workers only build the RdfParser objects (CPU-bound).
+        # writing to the DB is done here, in a single process and in
+        # the same order as the serial path.
+        logger.info("\tParsing with {} worker processes".format(nb_workers))
+        pool = multiprocessing.Pool(processes=nb_workers)
+        try:
+            nb_files = save(pool.imap(parse_entry, rdf_entries, chunksize=16))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        nb_files = save(itertools.imap(parse_entry, rdf_entries))
+
+    duration = time.time() - start
+    logger.info("\tParsed {nb} RDF files in {dur:.1f}s ({rate:.1f} files/s)"
+                .format(nb=nb_files, dur=duration,
+                        rate=nb_files / duration if duration else 0))
+
+    # books we know of but which are not in the catalog anymore.
+    # only relevant when the whole catalog has been looked at.
+    if incremental and not len(only_books):
+        removed_ids = known_ids - catalog_ids
+        logger.info("\tRemoving {} books not in catalog anymore"
+                    .format(len(removed_ids)))
+        with db.transaction():
+            for book_id in removed_ids:
+                delete_book_from_database(book_id)
+
+    # every book is now in line with the filters
+    if not len(only_books):
+        save_parse_filters(languages=languages, formats=formats)
+
+
+def parse_filters_for(languages=[], formats=[]):
+    """ (languages, formats) as stored in ParseFilters """
+    return (",".join(sorted(languages)), ",".join(sorted(formats)))
+
+
+def needs_full_parse(languages=[], formats=[]):
+    """ whether an incremental parse must parse unchanged RDF files too:
+        books out of new filters' scope are only removed when their file
+        is parsed, and books of a DB predating RdfFile have no checksum """
+    if not RdfFile.select().exists() and Book.select().exists():
+        return True
+    try:
+        previous = ParseFilters.get()
+    except ParseFilters.DoesNotExist:
+        return True
+    return (previous.languages, previous.formats) != \
+        parse_filters_for(languages=languages, formats=formats)
+
+
+def save_parse_filters(languages=[], formats=[]):
+    languages, formats = parse_filters_for(languages=languages,
+                                           formats=formats)
+    with db.transaction():
+        ParseFilters.delete().execute()
+        ParseFilters.create(languages=languages, formats=formats)
+
+
+def skip_rdf_folder(folder, only_books=set()):
+    """ whether RDF files in folder (named after book ID) are to be skipped
+
+        only_books is a set of book IDs as strings (see book_ids_set) """
+    if folder.endswith('999999'):
+        return True
+
+    # skip books outside of requsted list
+    return len(only_books) and path(folder).basename() not in only_books
+
+
+def book_ids_set(only_books):
+    return set([str(bid) for bid in only_books])
+
+
+def skip_rdf_fname(fname):
+    """ whether fname is not a parsable RDF file name """
+    if fname in ('.', '..', 'pg0.rdf'):
+        return True
+
+    return not fname.endswith('.rdf')
+
+
+def rdf_files_in(rdf_path, only_books=[]):
+    """ yields the path of every RDF file to parse in rdf_path """
+    only_books = book_ids_set(only_books)
     for root, dirs, files in os.walk(rdf_path):
-        if root.endswith('999999'):
+        if skip_rdf_folder(root, only_books=only_books):
             continue
 
-        # skip books outside of requsted list
-        if len(only_books) and path(root).basename() not in \
-            [str(bid) for bid in only_books]:
+        for fname in files:
+            if skip_rdf_fname(fname):
+                continue
+
+            yield os.path.join(root, fname)
+
+
+def rdf_entries_in_folder(rdf_path, only_books=[]):
+    """ yields (rdf_file, rdf_data) for every RDF file in rdf_path """
+    if len(only_books):
+        for rdf_entry in rdf_entries_for_books(rdf_path, only_books):
+            yield rdf_entry
+        return
+
+    for rdf_file in rdf_files_in(rdf_path):
+        yield read_rdf_file(rdf_file)
+
+
+def rdf_entries_for_books(rdf_path, only_books):
+    """ yields (rdf_file, rdf_data) for the RDF files of only_books
+
+        files are looked-up directly at {rdf_path}/{id}/pg{id}.rdf instead
+        of walking the whole folder. Those not found are skipped. """
+    rdf_files = []
+    for book_id in sorted(book_ids_set(only_books), key=int):
+        rdf_file = os.path.join(rdf_path, book_id,
+                                "pg{id}.rdf".format(id=book_id))
+        if skip_rdf_folder(os.path.dirname(rdf_file)) \
+                or skip_rdf_fname(os.path.basename(rdf_file)):
             continue
+        rdf_files.append(rdf_file)
 
-        for fname in files:
-            if fname in ('.', '..', 'pg0.rdf'):
+    if len(rdf_files) < PARALLEL_LOOKUP_MIN:
+        rdf_entries = itertools.imap(read_rdf_file_if_exists, rdf_files)
+        pool = None
+    else:
+        pool = ThreadPool(processes=LOOKUP_THREADS)
+        rdf_entries = pool.imap(read_rdf_file_if_exists, rdf_files)
+
+    try:
+        for rdf_entry in rdf_entries:
+            if rdf_entry is not None:
+                yield rdf_entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def rdf_entries_in_tarball(rdf_tarball, only_books=[], fileobj=None):
+    """ yields (member name, rdf_data) for every RDF file in rdf_tarball
+
+        members are decompressed and read sequentially, as a stream,
+        without anything being written to disk """
+    only_books = book_ids_set(only_books)
+    with tarfile.open(rdf_tarball, mode='r|bz2', fileobj=fileobj) as tar:
+        for member in tar:
+            if not member.isfile():
                 continue
 
-            if not fname.endswith('.rdf'):
+            folder, fname = os.path.split(member.name)
+            if skip_rdf_folder(folder, only_books=only_books) \
+                    or skip_rdf_fname(fname):
                 continue
 
-            fpath = os.path.join(root, fname)
-            parse_and_process_file(fpath)
+            yield member.name, tar.extractfile(member).read()
 
 
-def parse_and_process_file(rdf_file):
-    logger.info("\tParsing file {}".format(rdf_file))
+def rdf_entries_from_url(rdf_url, only_books=[], rdf_tarball=RDF_TARBALL,
+                         timeout=HTTP_TIMEOUT):
+    """ yields (member name, rdf_data) for every RDF file in rdf_url
+
+        the tarball is decompressed and read while being downloaded.
+        Downloaded bytes are saved to rdf_tarball for later runs. """
+    logger.info("\tStreaming {} into {}".format(rdf_url, rdf_tarball))
+    response = http_session().get(rdf_url, stream=True, timeout=timeout)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    partial_tarball = "{}.part".format(rdf_tarball)
+    with open(partial_tarball, 'wb') as f:
+        stream = TeeReader(response.raw, f)
+        for rdf_entry in rdf_entries_in_tarball(None, only_books=only_books,
+                                                fileobj=stream):
+            yield rdf_entry
+        # tarfile stops at the end-of-archive marker, not at end of file
+        stream.drain()
+    path(partial_tarball).move(rdf_tarball)
+
+
+def changed_rdf_entries(rdf_entries, checksums, catalog_ids):
+    """ yields rdf_entries which checksum differs from checksums[gid]
+
+        ID of every book in rdf_entries is added to catalog_ids """
+    for rdf_entry in rdf_entries:
+        gid = int(gid_for(rdf_entry[0]))
+        catalog_ids.add(gid)
+        if checksums.get(gid) == checksum_for(rdf_entry[1]):
+            continue
+        yield rdf_entry
+
+
+def gid_for(rdf_file):
+    """ book ID (as string) from the path of its RDF file """
+    return re.match(r'.*/pg([0-9]+).rdf', rdf_file).groups()[0]
+
+
+def checksum_for(rdf_data):
+    return hashlib.md5(rdf_data).hexdigest()
+
+
+def read_rdf_file(rdf_file):
     if not path(rdf_file).exists():
         raise ValueError(rdf_file)
 
-    gid = re.match(r'.*/pg([0-9]+).rdf', rdf_file).groups()[0]
-
     with open(rdf_file, 'r') as f:
-        parser = RdfParser(f.read(), gid).parse()
+        return rdf_file, f.read()
+
+
+def read_rdf_file_if_exists(rdf_file):
+    """ (rdf_file, rdf_data) or None if there is no such file """
+    if not path(rdf_file).exists():
+        return None
+    return read_rdf_file(rdf_file)
+
+
+def parse_rdf_entry(rdf_entry, engine='bs4'):
+    """ parsed RdfParser for a (name, rdf_data) entry. Run by parse workers """
+    rdf_file, rdf_data = rdf_entry
+    logger.info("\tParsing file {}".format(rdf_file))
+
+    parser = RDF_PARSERS[engine](rdf_data, gid_for(rdf_file)).parse()
+
+    # no need to send the raw RDF back to the writer process
+    parser.checksum = checksum_for(rdf_data)
+    parser.rdf_data = None
+    return parser
+
+
+def parse_rdf_file(rdf_file, engine='bs4'):
+    return parse_rdf_entry(read_rdf_file(rdf_file), engine=engine)
+
+
+def parse_and_process_file(rdf_file, engine='bs4'):
+    process_parsed_rdf(parse_rdf_file(rdf_file, engine=engine))
+
+
+def process_parsed_rdfs(parsers, batch_size=PARSE_BATCH_SIZE,
+                        languages=[], formats=[]):
+    """ save parsers in DB through a BulkLoader
+
+        returns the number of processed parsers """
+    loader = BulkLoader(batch_size=batch_size,
+                        languages=languages, formats=formats)
+    for parser in parsers:
+        loader.add(parser)
+    loader.flush()
+    return loader.nb_parsers
+
+
+def process_parsed_rdf(parser, languages=[], formats=[]):
+    if is_usable_rdf(parser):
+        save_rdf_in_database(parser, languages=languages, formats=formats)
+    else:
+        # might have been saved when its RDF file was usable
+        delete_book_from_database(parser.gid)
+
+    # record what the book was parsed from (for incremental parses)
+    RdfFile.insert(gid=parser.gid, checksum=parser.checksum).upsert().execute()
+
 
+def is_usable_rdf(parser):
+    gid = parser.gid
     if parser.license == 'None':
         logger.info("\tWARN: Unusable book without any information {}".format(gid))
     elif parser.title == '':
         logger.info("\tWARN: Unusable book without title {}".format(gid))
     else:
-        save_rdf_in_database(parser)
+        return True
+    return False
 
 
 class RdfParser():
@@ -105,6 +425,19 @@ class RdfParser():
         self.first_name = None
         self.last_name = None
 
+    def to_dict(self):
+        """ parsed values (see PARSED_FIELDS) with gid and checksum """
+        return dict([(field, getattr(self, field, None))
+                     for field in ('gid', 'checksum') + PARSED_FIELDS])
+
+    @classmethod
+    def from_dict(cls, fields):
+        """ parser with parsed values from a to_dict() output """
+        parser = cls(None, fields['gid'])
+        for field, value in fields.items():
+            setattr(parser, field, value)
+        return parser
+
     def parse(self):
         soup = BeautifulSoup(self.rdf_data, XML_PARSER, from_encoding='utf-8')
 
@@ -125,15 +458,17 @@ class RdfParser():
         # Because of a rare edge case that the field of the parsed author's name
         # has more than one comma we will join the first name in reverse, starting
         # with the second item.
-        self.author = soup.find('dcterms:creator') or soup.find('marcrel:com')
-        if self.author:
-            self.author_id = self.author.find('pgterms:agent')
+        # `author` is a soup Tag: kept local so the parser can be pickled.
+        author = soup.find('dcterms:creator') or soup.find('marcrel:com')
+        if author:
+            self.author_id = author.find('pgterms:agent')
             self.author_id = self.author_id.attrs['rdf:about'].split('/')[-1] \
                 if 'rdf:about' in getattr(self.author_id, 'attrs', '') else None
 
-            if self.author.find('pgterms:name'):
-                self.author_name = self.author.find('pgterms:name')
-                self.author_name = self.author_name.text.split(',')
+            # an empty name is no name
+            author_name = author.find('pgterms:name')
+            if author_name and author_name.text.strip():
+                self.author_name = author_name.text.split(',')
 
                 if len(self.author_name) > 1:
                     self.first_name = ' '.join(self.author_name[::-2]).strip()
@@ -172,14 +507,167 @@ class RdfParser():
         return self
 
 
-def save_rdf_in_database(parser):
+RDF_NAMESPACES = {
+    'rdf': "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    'pgterms': "http://www.gutenberg.org/2009/pgterms/",
+    'dcterms': "http://purl.org/dc/terms/",
+    'marcrel': "http://id.loc.gov/vocabulary/relators/",
+}
+
+
+def qname(tag):
+    """ lxml (Clark notation) name of a prefixed tag. ie: `dcterms:title` """
+    prefix, name = tag.split(':', 1)
+    return "{{{ns}}}{name}".format(ns=RDF_NAMESPACES[prefix], name=name)
+
+
+def element_text(elem):
+    """ text of elem and all its descendants (like soup's `.text`,
+        which shortens whitespace-only strings to a newline or a space) """
+    if elem is None:
+        return None
+    return ''.join([('\n' if '\n' in text else ' ')
+                    if text and not text.strip() else text
+                    for text in elem.itertext()])
+
+
+class LxmlRdfParser(RdfParser):
+
+    """
+    Same output as RdfParser but built in a single lxml `iterparse` pass
+    instead of a BeautifulSoup tree.
+    Elements are cleared once read so memory doesn't grow with the file.
+    Like RdfParser, only the first occurence of each node is considered.
+    """
+
+    EBOOK = qname('pgterms:ebook')
+    TITLE = qname('dcterms:title')
+    CREATOR = qname('dcterms:creator')
+    COMPILER = qname('marcrel:com')
+    AGENT = qname('pgterms:agent')
+    NAME = qname('pgterms:name')
+    BIRTHDATE = qname('pgterms:birthdate')
+    DEATHDATE = qname('pgterms:deathdate')
+    LANGUAGE = qname('dcterms:language')
+    DOWNLOADS = qname('pgterms:downloads')
+    RIGHTS = qname('dcterms:rights')
+    FILE = qname('pgterms:file')
+    VALUE = qname('rdf:value')
+    ABOUT = qname('rdf:about')
+
+    TEXT_TAGS = (TITLE, BIRTHDATE, DEATHDATE, DOWNLOADS, RIGHTS)
+
+    def parse(self):
+        rdf_data = self.rdf_data
+        if not isinstance(rdf_data, bytes):
+            rdf_data = rdf_data.encode('utf-8')
+
+        found = {}
+        self.file_types = {}
+        for event, elem in etree.iterparse(BytesIO(rdf_data),
+                                           events=('end',)):
+            tag = elem.tag
+            if tag in self.TEXT_TAGS:
+                if tag not in found:
+                    found[tag] = element_text(elem)
+
+            elif tag in (self.CREATOR, self.COMPILER):
+                if tag not in found:
+                    found[tag] = self.read_agent(elem)
+
+            elif tag == self.LANGUAGE:
+                if tag not in found:
+                    found[tag] = element_text(
+                        elem.find('.//{}'.format(self.VALUE)))
+
+            elif tag == self.FILE:
+                mime = element_text(elem.find('.//{}'.format(self.VALUE)))
+                if not mime.endswith('application/zip'):
+                    k = elem.get(self.ABOUT).split('/')[-1]
+                    self.file_types.update({k: mime})
+
+            # children of the ebook node are not needed once read.
+            parent = elem.getparent()
+            if parent is not None and parent.tag == self.EBOOK:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+        # see RdfParser.parse() for details on each field.
+        self.title = found.get(self.TITLE) or '- No Title -'
+        self.title = self.title.split('\n')[0]
+        self.subtitle = ' '.join(self.title.split('\n')[1:])
+
+        self.author_id = None
+        author = found.get(self.CREATOR) or found.get(self.COMPILER)
+        if author:
+            self.author_id, author_name = author
+            if author_name is not None and author_name.strip():
+                self.author_name = author_name.split(',')
+
+                if len(self.author_name) > 1:
+                    self.first_name = ' '.join(self.author_name[::-2]).strip()
+                self.last_name = self.author_name[0]
+
+        self.birth_year = get_formatted_number(found.get(self.BIRTHDATE))
+        self.death_year = get_formatted_number(found.get(self.DEATHDATE))
+
+        self.language = found.get(self.LANGUAGE)
+        self.downloads = found.get(self.DOWNLOADS)
+        self.license = found.get(self.RIGHTS)
+
+        return self
+
+    def read_agent(self, elem):
+        """ (author_id, name) tuple from a creator/compiler node """
+        agent = elem.find('.//{}'.format(self.AGENT))
+        author_id = agent.get(self.ABOUT) if agent is not None else None
+        if author_id is not None:
+            author_id = author_id.split('/')[-1]
+
+        return author_id, element_text(elem.find('.//{}'.format(self.NAME)))
+
+
+RDF_PARSERS = {'bs4': RdfParser}
+if etree is not None:
+    RDF_PARSERS['lxml'] = LxmlRdfParser
+
+PARSED_FIELDS = ('title', 'subtitle', 'author_id', 'author_name',
+                 'first_name', 'last_name', 'birth_year', 'death_year',
+                 'language', 'downloads', 'license', 'file_types')
+
+
+def compare_parsers(rdf_data, gid, engines=None):
+    """ list of (field, {engine: value}) for fields engines disagree on """
+    engines = engines or sorted(RDF_PARSERS.keys())
+    parsers = dict([(engine, RDF_PARSERS[engine](rdf_data, gid).parse())
+                    for engine in engines])
+    differences = []
+    for field in PARSED_FIELDS:
+        values = dict([(engine, getattr(parser, field, None))
+                       for engine, parser in parsers.items()])
+        if len(set([repr(v) for v in values.values()])) > 1:
+            differences.append((field, values))
+    return differences
+
+
+def save_rdf_in_database(parser, languages=[], formats=[]):
+    """ insert or update parser's book in DB
+
+        books outside of languages and formats (if set) are not saved
+        (removed if in DB), nor are files of other formats. """
+
+    if not is_in_scope(parser, languages=languages, formats=formats):
+        # might have been saved by a previous, unfiltered, parse.
+        delete_book_from_database(parser.gid)
+        return
 
     # Insert author, if it not exists
     if parser.author_id:
         try:
             author_record = Author.get(gut_id=parser.author_id)
             if parser.last_name:
-                author_record.last_name
+                author_record.last_name = parser.last_name
             if parser.first_name:
                 author_record.first_names = parser.first_name
             if parser.birth_year:
@@ -204,32 +692,101 @@ def save_rdf_in_database(parser):
     except:
         license_record = None
 
-    # Insert book
-    book_record = Book.create(
-        id=parser.gid,
+    book_formats = list(book_formats_for(parser, formats=formats))
+
+    # Insert (or update) book
+    book_fields = dict(
         title=parser.title.strip(),
         subtitle=parser.subtitle.strip(),
         author=author_record,  # foreign key
         license=license_record,  # foreign key
         language=parser.language.strip(),
-        downloads=parser.downloads
+        downloads=parser.downloads,
+        formats_mask=formats_mask_for([format_fields['mime']
+                                       for format_fields in book_formats])
     )
+    if Book.select().where(Book.id == parser.gid).exists():
+        Book.update(**book_fields).where(Book.id == parser.gid).execute()
+        book_record = Book.get(id=parser.gid)
+    else:
+        book_record = Book.create(id=parser.gid, **book_fields)
+
+    # {format id: book format id} of the formats already in DB, if updating.
+    # Those are kept (with their `downloaded_from`) if still listed.
+    former_formats = dict(BookFormat.select(BookFormat.format, BookFormat.id)
+                                    .where(BookFormat.book == book_record)
+                                    .tuples())
 
     # Insert formats
+    for format_fields in book_formats:
+
+        format_record = Format.get_or_create(**format_fields)
+
+        if former_formats.pop(format_record.id, None) is not None:
+            continue
+
+        # Insert book format
+        BookFormat.create(
+            book=book_record,  # foreign key
+            format=format_record  # foreign key
+        )
+
+    # remove formats not listed anymore
+    if former_formats:
+        BookFormat.delete().where(
+            BookFormat.id << list(former_formats.values())).execute()
+
+
+def sanitized_mime(mime):
+    if not mime.startswith('text/plain'):
+        mime = re.sub(r'; charset=[a-z0-9-]+', '', mime)
+    # else:
+    #    charset = re.match(r'; charset=([a-z0-9-]+)', mime).groups()[0]
+    return mime
+
+
+def wanted_mimes(formats):
+    """ MIME types of formats, plus HTML which is always downloaded """
+    return [FORMAT_MATRIX.get(f) for f in set(list(formats) + ['html'])]
+
+
+def is_in_scope(parser, languages=[], formats=[]):
+    """ whether parser's book passes the languages and formats filters
+
+        Same rules as get_list_of_filtered_books(): book must be in one of
+        languages and available in at least one of formats. """
+    if len(languages) and parser.language.strip() not in languages:
+        return False
+
+    if len(formats):
+        mimes = set([sanitized_mime(mime)
+                     for mime in parser.file_types.values()])
+        # formats book_formats_for() excludes are not saved
+        mimes -= set([FORMAT_MATRIX.get(f)
+                      for f in BAD_BOOKS_FORMATS.get(int(parser.gid), [])])
+        return bool(mimes & set([FORMAT_MATRIX.get(f) for f in formats]))
+
+    return True
+
+
+def book_formats_for(parser, formats=[]):
+    """ yields Format fields (mime, images, pattern) for parser's files
+
+        if formats is set, only files of those formats (and HTML) are """
+    mimes = wanted_mimes(formats) if len(formats) else None
     for file_type in parser.file_types:
 
         # Sanitize MIME
-        mime = parser.file_types[file_type]
-        if not mime.startswith('text/plain'):
-            mime = re.sub(r'; charset=[a-z0-9-]+', '', mime)
-        # else:
-        #    charset = re.match(r'; charset=([a-z0-9-]+)', mime).groups()[0]
+        mime = sanitized_mime(parser.file_types[file_type])
+
+        if mimes is not None and mime not in mimes:
+            continue
 
         # Insert format type
         pattern = re.sub(r'' + parser.gid, '{id}', file_type)
         pattern = pattern.split('/')[-1]
 
-        bid = int(book_record.id)
+        bid = int(parser.gid)
 
         if bid in BAD_BOOKS_FORMATS.keys() \
             and mime in [FORMAT_MATRIX.get(f)
@@ -238,18 +795,146 @@ def save_rdf_in_database(parser):
                          .format(mime, bid))
             continue
 
+        yield {'mime': mime,
+               'images': file_type.endswith('.images')
+               or parser.file_types[file_type] == 'application/pdf',
+               'pattern': pattern}
 
-        format_record = Format.get_or_create(
-            mime=mime,
-            images=file_type.endswith(
-                '.images') or parser.file_types[file_type] == 'application/pdf',
-            pattern=pattern)
 
-        # Insert book format
-        BookFormat.create(
-            book=book_record,  # foreign key
-            format=format_record  # foreign key
-        )
+class BulkLoader(object):
+
+    """
+    Saves parsers in DB like save_rdf_in_database() but in batches.
+
+    Books and their formats are buffered then written with multi-rows
+    INSERTs, a single transaction per batch. Authors, licenses and formats
+    are kept in memory instead of being looked-up for every book.
+    Books already in DB are handed over to save_rdf_in_database(), or
+    removed if their RDF file is not usable anymore.
+    languages and formats filters are applied as in save_rdf_in_database().
+    """
+
+    AUTHOR_FIELDS = (('last_name', 'last_name'),
+                     ('first_names', 'first_name'),
+                     ('birth_year', 'birth_year'),
+                     ('death_year', 'death_year'))
+
+    def __init__(self, batch_size=PARSE_BATCH_SIZE, languages=[], formats=[]):
+        self.batch_size = batch_size
+        self.languages = languages
+        self.formats_filter = formats
+        self.nb_parsers = 0
+
+        self.authors = dict([(author['gut_id'], author)
+                             for author in Author.select().dicts()])
+        self.licenses = dict(License.select(License.name, License.slug)
+                                    .tuples())
+        self.formats = dict([((fmt.mime, fmt.images, fmt.pattern), fmt.id)
+                             for fmt in Format.select()])
+        self.book_ids = set([bid for bid, in Book.select(Book.id).tuples()])
+        self.reset()
+
+    def reset(self):
+        self.new_authors = []
+        self.updated_authors = set()
+        self.books = []
+        self.book_formats = []
+        self.rdf_files = []
+        self.updated_books = []
+        self.removed_books = []
+
+    def add(self, parser):
+        self.nb_parsers += 1
+        if is_usable_rdf(parser):
+            in_scope = is_in_scope(parser, languages=self.languages,
+                                   formats=self.formats_filter)
+            if int(parser.gid) in self.book_ids:
+                # keeps in-memory author in sync with DB
+                if in_scope:
+                    self.author_for(parser)
+                self.updated_books.append(parser)
+            elif in_scope:
+                self.add_book(parser, self.author_for(parser))
+        elif int(parser.gid) in self.book_ids:
+            # might have been saved when its RDF file was usable
+            self.book_ids.discard(int(parser.gid))
+            self.removed_books.append(parser.gid)
+
+        self.rdf_files.append({'gid': int(parser.gid),
+                               'checksum': parser.checksum})
+        if len(self.rdf_files) >= self.batch_size:
+            self.flush()
+
+    def author_for(self, parser):
+        """ gut_id of parser's author, created or updated in memory """
+        if not parser.author_id:
+            # No author, set Anonymous
+            return '216'
+
+        author = self.authors.get(parser.author_id)
+        if author is None:
+            author = {'gut_id': parser.author_id}
+            author.update([(field, getattr(parser, attr))
+                           for field, attr in self.AUTHOR_FIELDS])
+            self.authors[parser.author_id] = author
+            self.new_authors.append(parser.author_id)
+        else:
+            for field, attr in self.AUTHOR_FIELDS:
+                if getattr(parser, attr):
+                    author[field] = getattr(parser, attr)
+            self.updated_authors.add(parser.author_id)
+        return parser.author_id
+
+    def add_book(self, parser, author_id):
+        book_id = int(parser.gid)
+        book_formats = list(book_formats_for(parser,
+                                             formats=self.formats_filter))
+        self.book_ids.add(book_id)
+        self.books.append({
+            'id': book_id,
+            'title': parser.title.strip(),
+            'subtitle': parser.subtitle.strip(),
+            'author': author_id,
+            'license': self.licenses.get(parser.license),
+            'language': parser.language.strip(),
+            'downloads': parser.downloads,
+            'formats_mask': formats_mask_for([format_fields['mime']
+                                              for format_fields
+                                              in book_formats])})
+
+        for format_fields in book_formats:
+            key = (format_fields['mime'], format_fields['images'],
+                   format_fields['pattern'])
+            if key not in self.formats:
+                self.formats[key] = Format.create(**format_fields).id
+            self.book_formats.append({'book': book_id,
+                                      'format': self.formats[key]})
+
+    def flush(self):
+        with db.transaction():
+            insert_rows(Author, [self.authors[author_id]
+                                 for author_id in self.new_authors])
+            for author_id in self.updated_authors - set(self.new_authors):
+                fields = dict(self.authors[author_id])
+                del fields['gut_id']
+                Author.update(**fields) \
+                      .where(Author.gut_id == author_id).execute()
+            insert_rows(Book, self.books)
+            insert_rows(BookFormat, self.book_formats)
+            for parser in self.updated_books:
+                save_rdf_in_database(parser, languages=self.languages,
+                                     formats=self.formats_filter)
+            for book_id in self.removed_books:
+                delete_book_from_database(book_id)
+            insert_rows(RdfFile, self.rdf_files, upsert=True)
+        self.reset()
+
+
+def delete_book_from_database(book_id):
+    """ remove a book, its formats and its RDF checksum from DB """
+    BookFormat.delete().where(BookFormat.book == book_id).execute()
+    Book.delete().where(Book.id == book_id).execute()
+    RdfFile.delete().where(RdfFile.gid == book_id).execute()
 
 
 def get_formatted_number(num):
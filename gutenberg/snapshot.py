@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import gzip
+import json
+import time
+
+from path import path
+
+from gutenberg import logger
+from gutenberg.rdf import RdfParser, book_ids_set, process_parsed_rdfs
+
+# Catalog snapshots hold parsed RDF files in a single portable file.
+# A snapshot is a gzip-compressed stream of JSON lines: the first line is
+# a header ({"format": ..., "version": ...}) and each following line is
+# an RdfParser.to_dict() output.
+# Loading a snapshot skips RDF parsing altogether.
+SNAPSHOT_FORMAT = 'gutenberg-catalog'
+SNAPSHOT_VERSION = 1
+
+
+def json_line(data):
+    return "{}\n".format(json.dumps(data)).encode('utf-8')
+
+
+class SnapshotWriter(object):
+
+    """ writes parsers to a snapshot file, as they are parsed """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.partial_fpath = "{}.part".format(fpath)
+        self.nb_parsers = 0
+
+    def __enter__(self):
+        logger.info("\tWriting catalog snapshot to {}".format(self.fpath))
+        self.fileobj = gzip.open(self.partial_fpath, 'wb', compresslevel=6)
+        self.fileobj.write(json_line({'format': SNAPSHOT_FORMAT,
+                                      'version': SNAPSHOT_VERSION,
+                                      'created_on': int(time.time())}))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fileobj.close()
+        if exc_type is None:
+            path(self.partial_fpath).move(self.fpath)
+            logger.info("\tWrote {} books to snapshot {}"
+                        .format(self.nb_parsers, self.fpath))
+        else:
+            path(self.partial_fpath).unlink_p()
+
+    def write(self, parser):
+        self.fileobj.write(json_line(parser.to_dict()))
+        self.nb_parsers += 1
+
+    def tee(self, parsers):
+        """ yields parsers once written to the snapshot """
+        for parser in parsers:
+            self.write(parser)
+            yield parser
+
+
+def read_snapshot(fpath, only_books=[]):
+    """ yields RdfParser objects (already parsed) from snapshot at fpath """
+    only_books = book_ids_set(only_books)
+    with gzip.open(fpath, 'rb') as f:
+        header = json.loads(f.readline().decode('utf-8'))
+        if header.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("{} is not a catalog snapshot".format(fpath))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported catalog snapshot version {} in {}"
+                             .format(header.get('version'), fpath))
+
+        for line in f:
+            fields = json.loads(line.decode('utf-8'))
+            if len(only_books) and fields['gid'] not in only_books:
+                continue
+            yield RdfParser.from_dict(fields)
+
+
+def load_snapshot(fpath, only_books=[], languages=[], formats=[]):
+    """ fill-up the DB from the snapshot at fpath
+
+        languages and formats filters apply as in parse_and_fill() """
+    logger.info("\tLoading catalog snapshot {}".format(fpath))
+
+    start = time.time()
+    nb_books = process_parsed_rdfs(read_snapshot(fpath, only_books=only_books),
+                                   languages=languages, formats=formats)
+    logger.info("\tLoaded {nb} books in {dur:.1f}s"
+                .format(nb=nb_books, dur=time.time() - start))
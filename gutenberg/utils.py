@@ -7,9 +7,18 @@ from __future__ import (unicode_literals, absolute_import,
 import os
 import re
 import hashlib
-from contextlib import contextmanager
+import logging
+import urlparse
+import threading
+from contextlib import contextmanager, closing
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import envoy
+import requests
+from requests.adapters import HTTPAdapter
 from path import path
 
 from gutenberg import logger
@@ -23,6 +32,13 @@ FORMAT_MATRIX = {
     'html': 'text/html'
 }
 
+# bit of each main format in Book.formats_mask
+FORMAT_BITS = {
+    'html': 1,
+    'epub': 2,
+    'pdf': 4
+}
+
 BAD_BOOKS_FORMATS = {
     39765: ['pdf'],
     40194: ['pdf'],
@@ -31,6 +47,20 @@ BAD_BOOKS_FORMATS = {
 
 NB_MAIN_LANGS = 5
 
+# ways of putting a file at another path, see link_or_copy()
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# seconds to wait for a mirror to accept a connection or send data
+HTTP_TIMEOUT = 60
+
+# connections kept alive to a single host (above download workers per host)
+HTTP_POOL_SIZE = 16
+
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+
+# ioctl cloning a file (copy-on-write) on Linux' btrfs, XFS… (linux/fs.h)
+FICLONE = 0x40049409
+
 
 @contextmanager
 def cd(newdir):
@@ -47,21 +77,166 @@ def exec_cmd(cmd):
     return envoy.run(str(cmd.encode('utf-8')))
 
 
-def download_file(url, fname):
-    output = "--output {}".format(fname) if fname else "--remote-name"
-    cmd = ("curl --fail --insecure --location {output} --silent "
-           "--show-error -C - --url {url}".format(output=output, url=url))
-    # logger.debug("--/ {}".format(cmd))
-    cmdr = exec_cmd(cmd)
-    return cmdr.status_code == 0
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    """ requests Session shared by all threads probing and downloading
+        files: connections to mirrors are kept alive and reused """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # mirrors' certificates have never been checked
+            session.verify = False
+            _http_session = session
+        return _http_session
+
+
+def resume_validator(response):
+    """ strong ETag, or else Last-Modified, of response: what If-Range
+        checks a partial download against, None if there is neither """
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def download_file(url, fname=None, timeout=HTTP_TIMEOUT):
+    """ downloads url to fname (url's file name by default).
+
+        Data is streamed to fname.part, renamed to fname once complete:
+        an interrupted download is resumed from there on next call, if
+        the file did not change since (see resume_validator()), which is
+        kept in fname.part.validator.
+        Returns whether the download succeeded """
+    if fname is None:
+        fname = path(urlparse.urlparse(url).path).basename()
+    partial_fname = "{}.part".format(fname)
+    validator_fname = "{}.validator".format(partial_fname)
+    offset = path(partial_fname).size if path(partial_fname).exists() else 0
+    validator = path(validator_fname).text().strip() \
+        if path(validator_fname).exists() else None
+
+    # ranges are of the file itself, not of a compressed version of it
+    headers = {'Accept-Encoding': 'identity'}
+    # without validator, the partial file might be of an older version
+    # of the file: it is then downloaded again from the start
+    if offset and validator:
+        headers['Range'] = "bytes={}-".format(offset)
+        # server sends the whole file if it changed
+        headers['If-Range'] = validator
+
+    try:
+        response = http_session().get(url, headers=headers, stream=True,
+                                      timeout=timeout)
+        if response.status_code >= 400:
+            # error pages are read for the connection to be reusable
+            response.content
+            if 'Range' in headers and response.status_code == \
+                    requests.codes.requested_range_not_satisfiable:
+                # partial file is not part of the current file: start over
+                path(partial_fname).unlink()
+                path(validator_fname).unlink_p()
+                return download_file(url, fname, timeout=timeout)
+            response.raise_for_status()
+
+        with closing(response):
+            if 'Range' not in headers or \
+                    response.status_code != requests.codes.partial_content:
+                offset = 0
+                # written before any data, for a later resume to check
+                validator = resume_validator(response)
+                if validator:
+                    path(validator_fname).write_text(validator)
+                else:
+                    path(validator_fname).unlink_p()
+            with open(partial_fname, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+            size = response.headers.get('content-length')
+            if size is not None and \
+                    path(partial_fname).size != offset + int(size):
+                logger.debug("\t\tIncomplete download of {}".format(url))
+                return False
+    except Exception as e:
+        # connection, timeout, HTTP or file errors
+        logger.debug("\t\tUnable to download {}: {}".format(url, e))
+        return False
+
+    path(partial_fname).move(fname)
+    path(validator_fname).unlink_p()
+    return True
+
+
+class TeeReader(object):
+
+    """ file-like reader copying everything read from fileobj into copy """
+
+    CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        return data
+
+    def drain(self):
+        """ read (and copy) what remains in fileobj """
+        while self.read(self.CHUNK_SIZE):
+            pass
+
+
+class LogCollector(logging.Handler):
 
-def main_formats_for(book):
-    fmts = [fmt.format.mime
-            for fmt in BookFormat.select(BookFormat, Book, Format)
-                                 .join(Book).switch(BookFormat)
-                                 .join(Format)
-                                 .where(Book.id == book.id)]
-    return [k for k, v in FORMAT_MATRIX.items() if v in fmts]
+    """ logging handler keeping (level, message) of records in memory,
+        so they can be replayed elsewhere, in order """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, self.format(record)))
+
+    def pop_records(self):
+        records, self.records = self.records, []
+        return records
+
+
+def formats_mask_for(mimes):
+    """ Book.formats_mask of a book available in those MIME types """
+    return sum([FORMAT_BITS[k] for k, v in FORMAT_MATRIX.items()
+                if v in mimes])
+
+
+def formats_from_mask(formats_mask):
+    """ main formats (keys of FORMAT_MATRIX) set in formats_mask """
+    return [k for k in FORMAT_MATRIX.keys() if formats_mask & FORMAT_BITS[k]]
+
+
+def companion_fname(book_id, fname):
+    """ name in download cache of file fname accompanying book_id's HTML """
+    return "{bid}_{fname}".format(bid=book_id, fname=fname)
+
+
+def companion_files_index(fnames):
+    """ {book id (as text): [companion file names]} of download cache
+        file names, for a direct lookup of each book's files """
+    index = {}
+    for fname in fnames:
+        book_id, sep, _ = fname.partition('_')
+        if sep:
+            index.setdefault(book_id, []).append(fname)
+    return index
 
 
 def get_list_of_filtered_books(languages, formats, only_books=[]):
@@ -110,14 +285,67 @@ def md5sum(fpath):
         return hashlib.md5(f.read()).hexdigest()
 
 
-def is_bad_cover(fpath):
+def tree_checksum(fpath):
+    """ md5 of names and contents of files in folder (or file) fpath,
+        None if it does not exist """
+    fpath = path(fpath)
+    if not fpath.exists():
+        return None
+    if fpath.isfile():
+        return md5sum(fpath)
+    checksum = hashlib.md5()
+    for fname in sorted(fpath.walkfiles()):
+        checksum.update(fpath.relpathto(fname).encode('utf-8'))
+        checksum.update(md5sum(fname))
+    return checksum.hexdigest()
+
+
+def is_bad_cover(data):
+    """ whether data (content of a cover image) is a known ugly cover """
     bad_sizes = [19263]
     bad_sums = ['a059007e7a2e86f2bf92e4070b3e5c73']
 
-    if path(fpath).size not in bad_sizes:
+    if len(data) not in bad_sizes:
         return False
 
-    return md5sum(fpath) in bad_sums
+    return hashlib.md5(data).hexdigest() in bad_sums
+
+
+def reflink(src, dst):
+    """ makes dst a copy-on-write clone of src: it shares its blocks
+        until either is modified """
+    if fcntl is None:
+        raise OSError("No reflink support on this platform")
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def link_or_copy(src, dst, mode='copy'):
+    """ puts src at dst as a copy, a hard link, a reflink or a symbolic
+        link (see LINK_MODES), falling back to a copy when mode is not
+        possible there (other filesystem, no reflink support…).
+
+        dst must not exist. Returns the mode actually used """
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return mode
+        if mode == 'reflink':
+            reflink(src, dst)
+            return mode
+        if mode == 'symlink':
+            os.symlink(path(src).abspath(), dst)
+            return mode
+    except (IOError, OSError) as e:
+        if not path(src).exists():
+            raise
+        logger.debug("\t\tUnable to {} {}, copying it: {}"
+                     .format(mode, dst, e))
+        path(dst).unlink_p()
+
+    path(src).copy(dst)
+    return 'copy'
 
 
 def path_for_cmd(p):